@@ -1,24 +1,57 @@
+import argparse
+import hashlib
+import importlib.util
 import json,os
+import multiprocessing
+import queue
+import random
+import shutil
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import torch
 import torch.nn as nn
 import pandas as pd
 import numpy as np
-import optuna  # For hyperparameter tuning
-from sklearn.model_selection import train_test_split
-from torch.utils.data import DataLoader, TensorDataset
-from torch.optim.lr_scheduler import ReduceLROnPlateau
+from torch.utils.data import DataLoader, Dataset, Sampler, Subset
 from tqdm import tqdm
 import math
-import matplotlib.pyplot as plt
-import seaborn as sns
-from sklearn.metrics import confusion_matrix
-from sklearn.cluster import KMeans
-from torch.cuda.amp import GradScaler, autocast
+from torch.amp import GradScaler, autocast
+from torch.profiler import record_function
 import torch.nn.functional as F
-from sklearn.mixture import GaussianMixture
-from scipy.signal import find_peaks
-import psutil
-from sklearn.preprocessing import StandardScaler
+
+def lazy_import(name):
+    """
+    Return module `name`, deferring its actual import until the first attribute access.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError(f"No module named {name!r}")
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+# Heavy optional dependencies are only loaded by the code paths that use them
+optuna = lazy_import("optuna")  # For hyperparameter tuning
+psutil = lazy_import("psutil")  # Resident memory of the profiler
+
+def pyplot():
+    """
+    Import matplotlib.pyplot with the non-interactive Agg backend (headless trainers, plot worker threads).
+    """
+    if "matplotlib.pyplot" not in sys.modules:
+        import matplotlib
+        matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    return plt
 
 # Check if GPU is available
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -26,13 +59,10 @@ print(f"Using device: {device}")
 
 # Plots
 # Function to compute accuracy per label (class)
-def compute_label_accuracy(y_true, y_pred, num_classes):
-    cm = confusion_matrix(y_true, y_pred, labels=range(num_classes))
-    label_accuracy = cm.diagonal() / cm.sum(axis=1)  # Class-wise accuracy
-    return label_accuracy, cm
 
 # Function to plot accuracy for all labels (classes)
 def plot_all_label_accuracy(label_accuracy, epoch, output_dir):
+    plt = pyplot()
     plt.figure(figsize=(10, 6))
     plt.bar(range(len(label_accuracy)), label_accuracy)
     plt.title(f"Per-Label Accuracy - Epoch {epoch + 1}")
@@ -46,6 +76,7 @@ def plot_all_label_accuracy(label_accuracy, epoch, output_dir):
 
 # Function to plot accuracy for all labels (classes)
 def plot_label_accuracy(label_accuracy, epoch, output_dir):
+    plt = pyplot()
     plt.figure(figsize=(10, 6))
     plt.bar(range(len(label_accuracy)), label_accuracy)
     plt.title(f"Per-Label Accuracy - Epoch {epoch + 1}")
@@ -58,8 +89,9 @@ def plot_label_accuracy(label_accuracy, epoch, output_dir):
     plt.close()
 
 # Function to plot and save confusion matrix
-def plot_confusion_matrix(y_true, y_pred, epoch, output_dir):
-    cm = confusion_matrix(y_true, y_pred)
+def plot_confusion_matrix(cm, epoch, output_dir):
+    import seaborn as sns
+    plt = pyplot()
     plt.figure(figsize=(8, 8))
     sns.heatmap(cm, annot=True, fmt='d', cmap='Blues', xticklabels=True, yticklabels=True)
     plt.title(f"Confusion Matrix - Epoch {epoch + 1}")
@@ -68,8 +100,192 @@ def plot_confusion_matrix(y_true, y_pred, epoch, output_dir):
     plt.savefig(os.path.join(output_dir, f"confusion_matrix_epoch_{epoch + 1}.png"))
     plt.close()
 
+class PlotWorker:
+    """
+    Run plot functions off the training loop: on one background thread, in one spawned
+    process, or inline ('sync'). A single worker keeps pyplot's global state single-threaded.
+    """
+    def __init__(self, mode='thread'):
+        self.mode = mode
+        self.futures = []
+        if mode == 'thread':
+            self.executor = ThreadPoolExecutor(max_workers=1)
+        elif mode == 'process':
+            self.executor = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"))
+        elif mode == 'sync':
+            self.executor = None
+        else:
+            raise ValueError(f"Unknown plot_mode {mode!r}, expected 'thread', 'process' or 'sync'.")
+
+    def submit(self, plot_fn, *args):
+        if self.executor is None:
+            plot_fn(*args)
+            return
+        # Surface failures of finished plots without waiting on the pending ones
+        for future in [f for f in self.futures if f.done()]:
+            self.futures.remove(future)
+            future.result()
+        self.futures.append(self.executor.submit(plot_fn, *args))
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            for future in self.futures:
+                future.result()
+            self.futures = []
+
+class PipelineProfiler:
+    """
+    Wall-clock timers for the training pipeline, written as one JSON record per line.
+
+    stage(name) times a block (CSV load, scaler fit/transform, evaluation, plotting, ...); stages nest
+    and each record names its parent. Inside train_epoch, lap(name) splits every step into data,
+    embedding, lstm, classifier, loss, backward, optimizer and bookkeeping time, summed into one
+    record per epoch with its samples/sec. Resident memory is sampled on a background thread and
+    every record carries the current and peak RSS. A disabled profiler does nothing.
+
+    With `trace_steps`, the first profiled train_epoch also records a torch.profiler trace of that
+    many steps (after `trace_skip` steps) and exports it as a Chrome trace to `trace_file`.
+    """
+    def __init__(self, path=None, enabled=False, trace_steps=0, trace_skip=10, trace_file=None, rss_interval=0.05):
+        self.enabled = enabled
+        self.stack = []
+        self.totals = defaultdict(float)
+        self.laps = None  # Per-step totals of the running train_epoch
+        self.trace_steps, self.trace_skip, self.trace_file = trace_steps, trace_skip, trace_file
+        self.trace = None
+        if not enabled:
+            return
+        self.cuda = device.type == 'cuda'
+        self.process = psutil.Process()
+        self.peak_rss = self.process.memory_info().rss
+        self.stopped = threading.Event()
+        self.sampler = threading.Thread(target=self.sample_rss, args=(rss_interval,), daemon=True)
+        self.sampler.start()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.file = open(path, "a")
+        self.log('run', pid=os.getpid(), device=str(device), config=dict(config))
+
+    def sample_rss(self, interval):
+        while not self.stopped.wait(interval):
+            self.peak_rss = max(self.peak_rss, self.process.memory_info().rss)
+
+    def sync(self):
+        # Queued CUDA kernels would otherwise be charged to whichever timer happens to wait for them
+        if self.cuda:
+            torch.cuda.synchronize()
+
+    def log(self, event, **fields):
+        if not self.enabled:
+            return
+        rss = self.process.memory_info().rss
+        self.peak_rss = max(self.peak_rss, rss)
+        record = {'event': event, 'time': time.time(), **fields, 'rss_mb': rss / 2**20, 'peak_rss_mb': self.peak_rss / 2**20}
+        self.file.write(json.dumps(record, default=float) + "\n")
+        self.file.flush()
+
+    @contextmanager
+    def stage(self, name, **fields):
+        """
+        Time the block as stage `name`. The block may add fields (e.g. 'samples') to the yielded record.
+        """
+        if not self.enabled:
+            yield {}
+            return
+        parent = self.stack[-1] if self.stack else None
+        self.stack.append(name)
+        self.sync()
+        start = time.perf_counter()
+        try:
+            yield fields
+        finally:
+            self.sync()
+            seconds = time.perf_counter() - start
+            self.stack.pop()
+            self.totals[name] += seconds
+            if 'samples' in fields:
+                fields['samples_per_sec'] = fields['samples'] / max(seconds, 1e-9)
+            self.log('stage', stage=name, parent=parent, seconds=seconds, **fields)
+
+    def begin_epoch(self):
+        """Start per-step laps (and the torch.profiler trace, once)."""
+        if not self.enabled:
+            return
+        self.laps = defaultdict(float)
+        self.epoch_start = self.last_lap = time.perf_counter()
+        if self.trace_steps and self.trace_file and self.trace is None:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.cuda:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.trace_steps_taken = 0
+            self.trace = torch.profiler.profile(
+                activities=activities,
+                schedule=torch.profiler.schedule(wait=self.trace_skip, warmup=1, active=self.trace_steps, repeat=1),
+                on_trace_ready=self.export_trace,
+                record_shapes=True,
+            )
+            self.trace.start()
+
+    def region(self, name):
+        """A torch.profiler range named `name` while profiling, else a no-op context."""
+        return record_function(name) if self.enabled else nullcontext()
+
+    def lap(self, name):
+        """Charge the time since the previous lap of this step to `name`."""
+        if self.laps is None:
+            return
+        self.sync()
+        now = time.perf_counter()
+        self.laps[name] += now - self.last_lap
+        self.last_lap = now
+
+    def step(self):
+        if self.trace is not None and self.trace_file:
+            self.trace_steps_taken += 1
+            self.trace.step()
+
+    def end_epoch(self, epoch, samples, **fields):
+        if self.laps is None:
+            return
+        seconds = time.perf_counter() - self.epoch_start
+        self.totals['train_epoch'] += seconds
+        self.log(
+            'train_epoch', phase=self.stack[0] if self.stack else None, epoch=epoch, seconds=seconds,
+            samples=samples, samples_per_sec=samples / max(seconds, 1e-9), step_seconds=dict(self.laps), **fields
+        )
+        self.laps = None
+        if self.trace is not None and self.trace_file:
+            self.trace.stop()
+            if self.traced_steps() < self.trace_steps:
+                print(f"Warning: the profiled epoch had {self.trace_steps_taken} steps, fewer than trace_skip + 1 + "
+                      f"trace_steps = {self.trace_skip + 1 + self.trace_steps}; "
+                      + (f"the trace holds {self.traced_steps()} steps." if self.traced_steps() else "no trace written."))
+            self.trace_file = None  # One trace per run
+
+    def traced_steps(self):
+        """Steps inside the trace window so far (the window opens after trace_skip + 1 warm-up steps)."""
+        return min(max(self.trace_steps_taken - self.trace_skip - 1, 0), self.trace_steps)
+
+    def export_trace(self, trace):
+        # Also called when end_epoch stops the profiler inside the window; nothing to write before it opens
+        if self.traced_steps():
+            trace.export_chrome_trace(self.trace_file)
+            self.log('trace', path=self.trace_file, steps=self.traced_steps(), skipped=self.trace_skip)
+
+    def close(self):
+        if not self.enabled:
+            return
+        self.stopped.set()
+        self.sampler.join()
+        self.log('summary', stage_seconds=dict(self.totals))
+        self.file.close()
+        self.enabled = False
+
+profiler = PipelineProfiler()  # Replaced by the __main__ block when config['profile'] is on
+
 # Function to plot accuracy
 def plot_accuracy(train_acc, test_acc, output_dir):
+    plt = pyplot()
     plt.figure(figsize=(10, 6))
     plt.plot(train_acc, label='Train Accuracy', color='blue')
     plt.plot(test_acc, label='Test Accuracy', color='red')
@@ -106,6 +322,79 @@ def approximate_with_normal_distribution(column_data, means, stds, k=2, decimal_
     return np.array(approximated_values)
 
 # CustomScale
+def as_float_matrix(data):
+    """Return `data` as a float32/float64 ndarray, copying only when the dtype has to change."""
+    if isinstance(data, (pd.DataFrame, pd.Series)):
+        data = data.to_numpy()
+    data = np.asarray(data)
+    if data.dtype != np.float32 and data.dtype != np.float64:
+        data = data.astype(np.float64)
+    return data
+
+def shrink_outliers_array(values, lower_bound, upper_bound, lshirk, ushirk):
+    """
+    Vectorized shrink_outliers over a whole matrix in one pass.
+
+    Values below `lower_bound` become lower_bound + (val - lower_bound) * lshirk and
+    values above `upper_bound` become upper_bound - (upper_bound - val) * ushirk.
+    """
+    shifted = np.where(values < lower_bound, lower_bound + (values - lower_bound) * lshirk, values)
+    return np.where(values > upper_bound, upper_bound - (upper_bound - values) * ushirk, shifted)
+
+def minmax_scale_array(shifted, adjusted_min, adjusted_max, lower_bound, upper_bound):
+    """
+    Scale every column of `shifted` to [lower_bound, upper_bound] using per-column parameter arrays.
+    Columns with no variation (adjusted_max == adjusted_min) are passed through unchanged.
+    """
+    span = adjusted_max - adjusted_min
+    constant = span == 0
+    scaled = lower_bound + (
+        (shifted - adjusted_min) /
+        np.where(constant, 1.0, span) * (upper_bound - lower_bound)
+    )
+    return np.where(constant, shifted, scaled)
+
+def token_limits(dtype):
+    """
+    Float clip range that casts into `dtype` without overflow: float(iinfo.max) of int64 rounds up to
+    2**63, which would wrap to the most negative token.
+    """
+    info = np.iinfo(dtype)
+    return float(info.min), float(np.nextafter(np.float64(info.max), 0))
+
+def to_tokens(scaled, dtype=np.int64):
+    """Convert scaled values to integer tokens, truncating toward zero like torch.tensor(..., dtype=torch.long)."""
+    return np.clip(scaled, *token_limits(dtype)).astype(dtype)
+
+class RowTokenizer:
+    """
+    Fast path of DSRMMCustomScaler.transform_tokens for serving: the per-column parameters are
+    turned into arrays once, and rows (a single flow or a micro-batch) go straight through NumPy
+    into a caller-provided token buffer, without building a DataFrame per request.
+    """
+    def __init__(self, scaler, dtype=np.int64):
+        params = scaler.column_params()
+        self.params = (params["adjusted_min"], params["adjusted_max"], params["lower_bound"], params["upper_bound"])
+        self.num_features = len(params["adjusted_min"])
+        self.lower_bound, self.upper_bound = scaler.lower_bound, scaler.upper_bound
+        self.lshirk, self.ushirk = config.get('lshirk'), config.get('ushirk')
+        self.dtype = np.dtype(dtype)
+        self.limits = token_limits(self.dtype)
+
+    def __call__(self, rows, out=None):
+        """
+        Tokenize `rows` ([num_features] or [n, num_features]); with `out`, write into out[:n] and return that view.
+        """
+        values = as_float_matrix(rows).reshape(-1, self.num_features)
+        shifted = shrink_outliers_array(values, self.lower_bound, self.upper_bound, self.lshirk, self.ushirk)
+        scaled = minmax_scale_array(shifted, *self.params)
+        np.clip(scaled, *self.limits, out=scaled)
+        if out is None:
+            return scaled.astype(self.dtype)
+        out = out[:len(scaled)]
+        out[...] = scaled  # Float to int assignment truncates toward zero, like to_tokens
+        return out
+
 def shift_outliers_ordered(series, lower_bound, upper_bound):
     # Separate the in-bound and outlier values
     in_bounds = series[(series >= lower_bound) & (series <= upper_bound)]
@@ -128,7 +417,8 @@ def shift_outliers_ordered(series, lower_bound, upper_bound):
     return series.map(map_value)
 
 class SRMMCustomScaler:
-    def __init__(self, lower_bound=0, upper_bound=29999, shirk=0.1, verbose=False, params_file="scaling_parameters.json"):
+    def __init__(self, lower_bound=0, upper_bound=29999, shirk=0.1, verbose=False, params_file="scaling_parameters.json",
+                 load_existing=False):
         """
         Initialize the scaler with thresholds and parameters.
         """
@@ -139,8 +429,8 @@ class SRMMCustomScaler:
         self.scale_dict = {}
         self.columns = None
 
-        # Check if the parameter file exists and load it if it does
-        if os.path.exists(self.params_file):
+        # Reuse a saved parameter file only when asked, so a stale file never stands in for a fit
+        if load_existing and os.path.exists(self.params_file):
             self.load_scale_dict(self.params_file)
             if self.verbose:
                 print(f"Loaded scaling parameters from {self.params_file}.")
@@ -150,19 +440,10 @@ class SRMMCustomScaler:
         """Shrink outliers toward the boundary values proportionally."""
         ushirk= config.get('ushirk')
         lshirk= config.get('lshirk')
-        ushirk
-        def shrink_below(val):
-            return lower_bound + (val - lower_bound) * lshirk
-
-        def shrink_above(val):
-            return upper_bound - (upper_bound - val) * ushirk
-
-        # Apply shrinking
-        series = series.copy()
-        series[series < lower_bound] = series[series < lower_bound].apply(shrink_below)
-        series[series > upper_bound] = series[series > upper_bound].apply(shrink_above)
-
-        return series
+        shifted = shrink_outliers_array(as_float_matrix(series), lower_bound, upper_bound, lshirk, ushirk)
+        if isinstance(series, pd.Series):
+            return pd.Series(shifted, index=series.index, name=series.name)
+        return shifted
 
     def save_scale_dict(self, file_path):
         def convert_to_serializable(obj):
@@ -213,25 +494,23 @@ class SRMMCustomScaler:
         """
         Fit the scaler to the data and compute the necessary scaling parameters.
         """
-        if isinstance(data, np.ndarray):
-            data = pd.DataFrame(data)
-        self.columns = data.columns
-
-        # Handle outliers and fit Min-Max scaling
-        shifted_data = data.copy()
-        for col in self.columns:
-            shifted_data[col] = self.shrink_outliers(data[col], self.lower_bound, self.upper_bound)
+        self.columns = data.columns if isinstance(data, pd.DataFrame) else None
+        values = as_float_matrix(data)
+        if self.columns is None:
+            self.columns = pd.RangeIndex(values.shape[1])
 
-            # Store modified min and max values for columns with adjusted outliers
-            modified_min = shifted_data[col].min()
-            modified_max = shifted_data[col].max()
+        # Handle outliers and fit Min-Max scaling over the whole matrix at once
+        shifted_values = self.shrink_outliers(values, self.lower_bound, self.upper_bound)
+        original_min, original_max = np.nanmin(values, axis=0), np.nanmax(values, axis=0)
+        adjusted_min, adjusted_max = np.nanmin(shifted_values, axis=0), np.nanmax(shifted_values, axis=0)
 
+        for i, col in enumerate(self.columns):
             self.scale_dict[col] = {
                 "method": "shrink_outliers",
-                "original_min": data[col].min(),
-                "original_max": data[col].max(),
-                "adjusted_min": modified_min,
-                "adjusted_max": modified_max,
+                "original_min": original_min[i],
+                "original_max": original_max[i],
+                "adjusted_min": adjusted_min[i],
+                "adjusted_max": adjusted_max[i],
                 "lower_bound": self.lower_bound,
                 "upper_bound": self.upper_bound
             }
@@ -242,52 +521,61 @@ class SRMMCustomScaler:
         # Save parameters to file
         self.save_scale_dict(self.params_file)
 
-    def transform(self, data):
+    def column_params(self):
         """
-        Transform the data using the fitted scaler and scale it to [lower_bound, upper_bound].
+        Return the fitted per-column parameters as float64 arrays in column order.
+        """
+        columns = self.columns if self.columns is not None else list(self.scale_dict)
+        params = [self.scale_dict[col] if col in self.scale_dict else self.scale_dict[str(col)] for col in columns]
+        return {
+            name: np.array([p[name] for p in params], dtype=np.float64)
+            for name in ("adjusted_min", "adjusted_max", "lower_bound", "upper_bound")
+        }
+
+    def transform_array(self, data):
+        """
+        Shrink outliers and min-max scale a whole matrix in one pass and return a float ndarray.
         """
         if not self.scale_dict:
             raise ValueError("Scaler has not been fitted. Call 'fit' before 'transform'.")
 
-        if isinstance(data, np.ndarray):
-            data = pd.DataFrame(data, columns=self.columns)
-
-        shifted_data = data.copy()
-        for col in self.columns:
-            shifted_data[col] = self.shrink_outliers(data[col], self.lower_bound, self.upper_bound)
-
-        transformed_data = pd.DataFrame(index=shifted_data.index, columns=shifted_data.columns)
-
-        for col in self.columns:
-            params = self.scale_dict[col]
-            adjusted_min = params["adjusted_min"]
-            adjusted_max = params["adjusted_max"]
-            lower_bound, upper_bound = params["lower_bound"], params["upper_bound"]
+        params = self.column_params()
+        shifted_values = self.shrink_outliers(as_float_matrix(data), self.lower_bound, self.upper_bound)
+        transformed_values = minmax_scale_array(
+            shifted_values, params["adjusted_min"], params["adjusted_max"],
+            params["lower_bound"], params["upper_bound"]
+        )
 
-            # Handle columns with no variation
-            if adjusted_max == adjusted_min:
-                if self.verbose:
+        # Debug information
+        if self.verbose:
+            columns = self.columns if self.columns is not None else list(self.scale_dict)
+            col_min, col_max = transformed_values.min(axis=0), transformed_values.max(axis=0)
+            for i, col in enumerate(columns):
+                if params["adjusted_max"][i] == params["adjusted_min"][i]:
                     print(f"Column '{col}' has a constant value. Scaling skipped.")
-                transformed_data[col] = shifted_data[col]
-            else:
-                # Scale data to [lower_bound, upper_bound]
-                transformed_data[col] = lower_bound + (
-                    (shifted_data[col] - adjusted_min) /
-                    (adjusted_max - adjusted_min) * (upper_bound - lower_bound)
-                )
-
-            # Debug information
-            if self.verbose:
                 print(f"Column '{col}':\n"
-                      f"Min value after scaling: {transformed_data[col].min()},\n"
-                      f"Max value after scaling: {transformed_data[col].max()},\n"
-                      f"Adjusted Min: {adjusted_min},\n"
-                      f"Adjusted Max: {adjusted_max}.")
-
-        if self.verbose:
+                      f"Min value after scaling: {col_min[i]},\n"
+                      f"Max value after scaling: {col_max[i]},\n"
+                      f"Adjusted Min: {params['adjusted_min'][i]},\n"
+                      f"Adjusted Max: {params['adjusted_max'][i]}.")
             print("Transformed data using the fitted scaler.")
 
-        return transformed_data
+        return transformed_values
+
+    def transform_tokens(self, data, dtype=np.int64):
+        """
+        Transform the data and emit the integer token array fed to the embedding.
+        """
+        return to_tokens(self.transform_array(data), dtype=dtype)
+
+    def transform(self, data):
+        """
+        Transform the data using the fitted scaler and scale it to [lower_bound, upper_bound].
+        """
+        transformed_values = self.transform_array(data)
+        if isinstance(data, pd.DataFrame):
+            return pd.DataFrame(transformed_values, index=data.index, columns=data.columns)
+        return pd.DataFrame(transformed_values, columns=self.columns)
 
     def fit_transform(self, data):
         """
@@ -297,7 +585,8 @@ class SRMMCustomScaler:
         return self.transform(data)
 
 class DSRMMCustomScaler:
-    def __init__(self, lower_bound=0, upper_bound=29999, shirk=0.1, verbose=False, params_file="scaling_parameters.json"):
+    def __init__(self, lower_bound=0, upper_bound=29999, shirk=0.1, verbose=False, params_file="scaling_parameters.json",
+                 load_existing=False):
         """
         Initialize the scaler with thresholds and parameters.
         """
@@ -307,9 +596,10 @@ class DSRMMCustomScaler:
         self.params_file = params_file
         self.scale_dict = {}
         self.columns = None
+        self.running_stats = None  # Running min/max accumulated by partial_fit
 
-        # Check if the parameter file exists and load it if it does
-        if os.path.exists(self.params_file):
+        # Reuse a saved parameter file only when asked, so a stale file never stands in for a fit
+        if load_existing and os.path.exists(self.params_file):
             self.load_scale_dict(self.params_file)
             if self.verbose:
                 print(f"Loaded scaling parameters from {self.params_file}.")
@@ -319,19 +609,10 @@ class DSRMMCustomScaler:
         """Shrink outliers toward the boundary values proportionally."""
         ushirk= config.get('ushirk')
         lshirk= config.get('lshirk')
-        ushirk
-        def shrink_below(val):
-            return lower_bound + (val - lower_bound) * lshirk
-
-        def shrink_above(val):
-            return upper_bound - (upper_bound - val) * ushirk
-
-        # Apply shrinking
-        series = series.copy()
-        series[series < lower_bound] = series[series < lower_bound].apply(shrink_below)
-        series[series > upper_bound] = series[series > upper_bound].apply(shrink_above)
-
-        return series
+        shifted = shrink_outliers_array(as_float_matrix(series), lower_bound, upper_bound, lshirk, ushirk)
+        if isinstance(series, pd.Series):
+            return pd.Series(shifted, index=series.index, name=series.name)
+        return shifted
 
     def save_scale_dict(self, file_path):
         def convert_to_serializable(obj):
@@ -382,85 +663,132 @@ class DSRMMCustomScaler:
         """
         Fit the scaler to the data and compute the necessary scaling parameters.
         """
-        if isinstance(data, np.ndarray):
-            data = pd.DataFrame(data)
-        self.columns = data.columns
+        self.columns = data.columns if isinstance(data, pd.DataFrame) else None
+        values = as_float_matrix(data)
+        if self.columns is None:
+            self.columns = pd.RangeIndex(values.shape[1])
+        self.running_stats = None
+
+        # Handle outliers and fit Min-Max scaling over the whole matrix at once
+        shifted_values = self.shrink_outliers(values, self.lower_bound, self.upper_bound)
+        self.update_scale_dict(
+            np.nanmin(values, axis=0), np.nanmax(values, axis=0),
+            np.nanmin(shifted_values, axis=0), np.nanmax(shifted_values, axis=0)
+        )
+        if self.verbose:
+            print(f"Fitted scaler. Columns: {list(self.columns)}")
 
-        # Handle outliers and fit Min-Max scaling
-        shifted_data = data.copy()
-        for col in self.columns:
-            shifted_data[col] = self.shrink_outliers(data[col], self.lower_bound, self.upper_bound)
+        # Save parameters to file
+        self.save_scale_dict(self.params_file)
 
-            # Store modified min and max values for columns with adjusted outliers
-            modified_min = shifted_data[col].min()
-            modified_max = shifted_data[col].max()
+    def partial_fit(self, data):
+        """
+        Update the min/max statistics incrementally from one chunk of data.
+        Call 'save_scale_dict' once the last chunk has been seen.
+        """
+        values = as_float_matrix(data)
+        if values.shape[0] == 0:
+            return
+
+        if self.running_stats is None:
+            self.columns = data.columns if isinstance(data, pd.DataFrame) else pd.RangeIndex(values.shape[1])
+            self.running_stats = {
+                name: np.full(values.shape[1], np.nan)
+                for name in ("original_min", "original_max", "adjusted_min", "adjusted_max")
+            }
+
+        # fmin/fmax skip NaN the same way the full-matrix nanmin/nanmax do
+        shifted_values = self.shrink_outliers(values, self.lower_bound, self.upper_bound)
+        stats = self.running_stats
+        stats["original_min"] = np.fmin(stats["original_min"], np.nanmin(values, axis=0))
+        stats["original_max"] = np.fmax(stats["original_max"], np.nanmax(values, axis=0))
+        stats["adjusted_min"] = np.fmin(stats["adjusted_min"], np.nanmin(shifted_values, axis=0))
+        stats["adjusted_max"] = np.fmax(stats["adjusted_max"], np.nanmax(shifted_values, axis=0))
+        self.update_scale_dict(**stats)
 
+    def update_scale_dict(self, original_min, original_max, adjusted_min, adjusted_max):
+        """
+        Rebuild the per-column scaling parameters from column-wise min/max arrays.
+        """
+        threshold=config.get('threshold')
+        for i, col in enumerate(self.columns):
             # Calculate k-neighbor
-            threshold=config.get('threshold')
-            k_neighbor = min(modified_max / ((self.upper_bound - self.lower_bound) / threshold), 15)
+            k_neighbor = min(adjusted_max[i] / ((self.upper_bound - self.lower_bound) / threshold), 15)
 
             self.scale_dict[col] = {
                 "method": "shrink_outliers",
-                "original_min": data[col].min(),
-                "original_max": data[col].max(),
-                "adjusted_min": modified_min,
-                "adjusted_max": modified_max,
+                "original_min": original_min[i],
+                "original_max": original_max[i],
+                "adjusted_min": adjusted_min[i],
+                "adjusted_max": adjusted_max[i],
                 "lower_bound": self.lower_bound,
                 "upper_bound": self.upper_bound,
                 "k_neighbor": k_neighbor  # Save k-neighbor for downstream use
             }
-        if self.verbose:
-            print(f"Fitted scaler. Columns: {list(self.columns)}")
 
-        # Save parameters to file
-        self.save_scale_dict(self.params_file)
-
-    def transform(self, data):
+    def column_params(self):
         """
-        Transform the data using the fitted scaler and scale it to [lower_bound, upper_bound].
+        Return the fitted per-column parameters as float64 arrays in column order.
+        """
+        columns = self.columns if self.columns is not None else list(self.scale_dict)
+        params = [self.scale_dict[col] if col in self.scale_dict else self.scale_dict[str(col)] for col in columns]
+        return {
+            name: np.array([p[name] for p in params], dtype=np.float64)
+            for name in ("adjusted_min", "adjusted_max", "lower_bound", "upper_bound")
+        }
+
+    def transform_array(self, data):
+        """
+        Shrink outliers and min-max scale a whole matrix in one pass and return a float ndarray.
         """
         if not self.scale_dict:
             raise ValueError("Scaler has not been fitted. Call 'fit' before 'transform'.")
 
-        if isinstance(data, np.ndarray):
-            data = pd.DataFrame(data, columns=self.columns)
-
-        shifted_data = data.copy()
-        for col in self.columns:
-            shifted_data[col] = self.shrink_outliers(data[col], self.lower_bound, self.upper_bound)
-
-        transformed_data = pd.DataFrame(index=shifted_data.index, columns=shifted_data.columns)
-
-        for col in self.columns:
-            params = self.scale_dict[col]
-            adjusted_min = params["adjusted_min"]
-            adjusted_max = params["adjusted_max"]
-            lower_bound, upper_bound = params["lower_bound"], params["upper_bound"]
+        params = self.column_params()
+        shifted_values = self.shrink_outliers(as_float_matrix(data), self.lower_bound, self.upper_bound)
+        transformed_values = minmax_scale_array(
+            shifted_values, params["adjusted_min"], params["adjusted_max"],
+            params["lower_bound"], params["upper_bound"]
+        )
 
-            # Handle columns with no variation
-            if adjusted_max == adjusted_min:
-                if self.verbose:
+        # Debug information
+        if self.verbose:
+            columns = self.columns if self.columns is not None else list(self.scale_dict)
+            col_min, col_max = transformed_values.min(axis=0), transformed_values.max(axis=0)
+            for i, col in enumerate(columns):
+                if params["adjusted_max"][i] == params["adjusted_min"][i]:
                     print(f"Column '{col}' has a constant value. Scaling skipped.")
-                transformed_data[col] = shifted_data[col]
-            else:
-                # Scale data to [lower_bound, upper_bound]
-                transformed_data[col] = lower_bound + (
-                    (shifted_data[col] - adjusted_min) /
-                    (adjusted_max - adjusted_min) * (upper_bound - lower_bound)
-                )
-
-            # Debug information
-            if self.verbose:
                 print(f"Column '{col}':\n"
-                      f"Min value after scaling: {transformed_data[col].min()},\n"
-                      f"Max value after scaling: {transformed_data[col].max()},\n"
-                      f"Adjusted Min: {adjusted_min},\n"
-                      f"Adjusted Max: {adjusted_max}.")
-
-        if self.verbose:
+                      f"Min value after scaling: {col_min[i]},\n"
+                      f"Max value after scaling: {col_max[i]},\n"
+                      f"Adjusted Min: {params['adjusted_min'][i]},\n"
+                      f"Adjusted Max: {params['adjusted_max'][i]}.")
             print("Transformed data using the fitted scaler.")
 
-        return transformed_data
+        return transformed_values
+
+    def transform_tokens(self, data, dtype=np.int64):
+        """
+        Transform the data and emit the integer token array fed to the embedding.
+        """
+        return to_tokens(self.transform_array(data), dtype=dtype)
+
+    def row_tokenizer(self, dtype=np.int64):
+        """
+        RowTokenizer bound to the current parameters, for per-flow transforms on the serving path.
+        """
+        if not self.scale_dict:
+            raise ValueError("Scaler has not been fitted. Call 'fit' before 'transform'.")
+        return RowTokenizer(self, dtype)
+
+    def transform(self, data):
+        """
+        Transform the data using the fitted scaler and scale it to [lower_bound, upper_bound].
+        """
+        transformed_values = self.transform_array(data)
+        if isinstance(data, pd.DataFrame):
+            return pd.DataFrame(transformed_values, index=data.index, columns=data.columns)
+        return pd.DataFrame(transformed_values, columns=self.columns)
 
     def fit_transform(self, data):
         """
@@ -469,6 +797,106 @@ class DSRMMCustomScaler:
         self.fit(data)
         return self.transform(data)
 
+class TokenVocabulary:
+    """
+    Per-column dictionary of the token values seen when the scaler was fitted.
+
+    DSRMMCustomScaler maps every column onto [lower_bound, upper_bound], but each column only
+    produces a small set of distinct tokens. Observed tokens get compact ids 0..num_tokens-1
+    (shared across columns, like the value embedding), and only the raw embedding rows their
+    ±k/2 neighbor windows reach are kept (num_rows), so GraphAvgColAmplifiedEmbedding averages
+    exactly the same windows as over the full index range. Tokens never seen in a column are
+    snapped to the nearest token observed in that column.
+    """
+    COLUMN_SHIFT = 32  # Search keys are (column << COLUMN_SHIFT) | token, so one searchsorted covers every column
+
+    def __init__(self, k=None, vocab_size=None):
+        self.k = k if k is not None else config.get('nearest_neighbour')
+        self.vocab_size = vocab_size if vocab_size is not None else config['vocab_size']
+        self.column_tokens = None  # Sorted observed tokens of every column
+        self.tokens = None  # Compact id -> raw token
+        self.rows = None  # Compact embedding row -> raw embedding row
+        self.window_rows = None  # [num_tokens, window] compact rows averaged for every compact id
+
+    @property
+    def num_tokens(self):
+        return len(self.tokens)
+
+    @property
+    def num_rows(self):
+        return len(self.rows)
+
+    def fit(self, tokens):
+        self.column_tokens = None
+        self.partial_fit(tokens)
+        return self
+
+    def partial_fit(self, tokens):
+        """Add the tokens of one chunk ([n, num_columns]) to the per-column dictionaries."""
+        tokens = np.asarray(tokens, dtype=np.int64)
+        if self.column_tokens is None:
+            self.column_tokens = [np.empty(0, dtype=np.int64) for _ in range(tokens.shape[1])]
+        self.column_tokens = [np.union1d(seen, tokens[:, i]) for i, seen in enumerate(self.column_tokens)]
+        self.build()
+
+    def build(self):
+        """Derive the compact ids, embedding rows, and search keys from the per-column dictionaries."""
+        self.tokens = np.unique(np.concatenate(self.column_tokens))
+
+        # Same offsets and clamping as GraphAvgColAmplifiedEmbedding.neighbour_indices
+        offsets = np.arange(-self.k // 2, self.k // 2 + 1)
+        raw_windows = np.clip(self.tokens[:, None] + offsets, 0, self.vocab_size - 1)
+        self.rows, inverse = np.unique(raw_windows.ravel(), return_inverse=True)
+        self.window_rows = inverse.reshape(raw_windows.shape)
+
+        lengths = [len(column) for column in self.column_tokens]
+        self.column_start = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        self.column_end = self.column_start + np.array(lengths) - 1
+        self.keys = np.concatenate([
+            (i << self.COLUMN_SHIFT) | column for i, column in enumerate(self.column_tokens)
+        ])
+        self.key_ids = np.searchsorted(self.tokens, np.concatenate(self.column_tokens))
+
+    def encode(self, tokens, dtype=np.int64, out=None):
+        """
+        Map raw tokens ([n, num_columns]) to compact ids; with `out`, write into it (in place is fine).
+        """
+        tokens = np.asarray(tokens, dtype=np.int64).reshape(-1, len(self.column_tokens))
+        columns = np.arange(tokens.shape[1])
+        queries = (columns << self.COLUMN_SHIFT) | np.clip(tokens, 0, (1 << self.COLUMN_SHIFT) - 1)
+
+        # Nearest observed token of the same column: the insertion point or the entry before it
+        right = np.clip(np.searchsorted(self.keys, queries), self.column_start, self.column_end)
+        left = np.maximum(right - 1, self.column_start)
+        use_left = np.abs(queries - self.keys[left]) <= np.abs(self.keys[right] - queries)
+        ids = self.key_ids[np.where(use_left, left, right)]
+
+        if out is None:
+            return ids.astype(dtype)
+        out[...] = ids
+        return out
+
+    def save(self, file_path):
+        np.savez(
+            file_path,
+            column_tokens=np.concatenate(self.column_tokens),
+            column_lengths=np.array([len(column) for column in self.column_tokens]),
+            k=self.k,
+            vocab_size=self.vocab_size,
+        )
+
+    @classmethod
+    def load(cls, file_path):
+        with np.load(file_path) as data:
+            vocabulary = cls(k=int(data['k']), vocab_size=int(data['vocab_size']))
+            vocabulary.column_tokens = np.split(data['column_tokens'], np.cumsum(data['column_lengths'])[:-1])
+        vocabulary.build()
+        return vocabulary
+
+def vocabulary_path(params_file):
+    """Token vocabulary file stored next to the scaler's parameter file."""
+    return os.path.join(os.path.dirname(params_file), config['vocabulary_file'])
+
 # Configuration Dictionary
 Embedingconfig = {
     'scalej': 10,
@@ -498,7 +926,54 @@ config = {
     'kernel_size': 3,
     'amplify_embedding_dim': 64,
     'num_graph_layers': 3,
-    'nearest_neighbour': 11
+    'nearest_neighbour': 11,
+    'streaming': False, # Read the CSV in chunks and write tokens to on-disk arrays
+    'chunk_size': 500000, # Rows per CSV chunk in streaming mode
+    'token_dtype': 'int32', # On-disk dtype for scaled tokens (vocab_size fits in int32)
+    'label_dtype': 'int8', # On-disk dtype for labels (34 classes)
+    'num_workers': 0, # DataLoader worker processes
+    'persistent_workers': True, # Keep workers alive between epochs (num_workers > 0)
+    'prefetch_factor': 2, # Batches prefetched per worker (num_workers > 0)
+    'pin_memory': True, # Pin host batches when training on CUDA
+    'background_prefetch': False, # Fetch and copy batches to the device on a background thread
+    'prefetch_batches': 2, # Queue depth of the background prefetcher
+    'log_interval': 50, # Steps between host syncs for the progress-bar metrics
+    'amp': False, # Mixed-precision autocast in train_epoch/evaluate
+    'amp_dtype': 'bfloat16', # bfloat16 runs on CPU and CUDA; float16 (CUDA) enables loss scaling
+    'compile_model': False, # Wrap DetectionModelLSTM with torch.compile
+    'attention_sdpa': False, # Route MultiHeadAnomalyAwareSelfAttention through scaled_dot_product_attention
+    'attention_mode': 'exact', # 'exact' (seq x seq scores) or 'nystrom' (landmark approximation, O(seq * m))
+    'num_landmarks': 16, # Landmarks m for the nystrom attention mode
+    'landmark_sampler': 'max_norm', # 'max_norm' or 'random' landmark selection
+    'landmark_pinv_rtol': 1e-2, # Singular values below rtol * largest are dropped when inverting the landmark kernel
+    'n_trials': 20, # Optuna trials in total (already finished trials of a resumed study count)
+    'search_workers': 1, # Processes running Optuna trials in parallel
+    'study_name': 'bcudemo_lr', # Optuna study name prefix inside the storage (suffixed with the search_key)
+    'study_storage': 'optuna_journal.log', # Journal file (or sqlite:///...) so interrupted studies resume
+    'study_heartbeat': 60, # RDB storages: seconds between trial heartbeats; trials silent for 2x are failed and retried
+    'pruner': 'hyperband', # 'hyperband', 'successive_halving' or 'none'
+    'report_interval': 100, # Training steps between intermediate reports to the pruner
+    'search_fidelity': False, # Multi-fidelity search: trials grow through stratified training subsets
+    'fidelity_fractions': [0.1, 0.3, 1.0], # Cumulative fraction of the training set seen after each rung
+    'validation_fraction': 0.25, # Fixed stratified share of the test set scored after each rung
+    'fidelity_seed': 40, # Seed of the stratified subset order
+    'fallback_lrs': [0.0004, 0.0002, 0.0001, 0.00005], # Learning rates used when no search trial completed
+    'checkpoint_dir': 'checkpoints', # last.pt (periodic) and best.pt (lowest test loss) for final_training
+    'checkpoint_interval': 500, # Training steps between mid-epoch checkpoints (0: end of epoch only)
+    'plot_mode': 'thread', # Render training plots on a 'thread', in a 'process', or inline ('sync')
+    'plot_every': 1, # Plot every N epochs; 0 only plots after the last epoch
+    'compact_vocabulary': False, # Encode tokens with the fitted TokenVocabulary and size the value embedding to the observed windows
+    'vocabulary_file': 'token_vocabulary.npz', # TokenVocabulary file, saved next to scaling_parameters.json
+    'sparse_embedding': False, # Sparse value-embedding gradients, updated by SparseAdam (AdamW for the other parameters)
+    'preprocess_cache': True, # Reuse scaled tokens keyed by the CSV hash and preprocessing config
+    'cache_dir': 'preprocess_cache', # Root of the content-addressed preprocessing artifacts
+    'weighted_unique': False, # Train/evaluate on distinct (row, label) pairs, weighting the loss and metrics by their counts
+    'output_dir': 'training_outputs', # Plots and profiling output of final_training
+    'profile': False, # Stage timers, per-epoch step breakdown, samples/sec and peak RSS as JSONL in output_dir
+    'profile_file': 'profile.jsonl', # Profiling records (appended, one JSON object per line)
+    'profile_trace_steps': 0, # torch.profiler trace of this many steps of the first profiled epoch (0: no trace)
+    'profile_trace_skip': 10, # Steps run before the traced window starts
+    'profile_trace_file': 'profile_trace.json' # Chrome trace (chrome://tracing, Perfetto) written to output_dir
 }
 
 # Label Mapping
@@ -538,68 +1013,475 @@ LABEL_MAPPING = {
     'DDoS-UDP_Flood': 32,
     'DDoS-ICMP_Flood': 33
 }
-# Load Dataset
-input_csv = r"./estimate_1/subset_1.csv"
-data = pd.read_csv(input_csv)
-features = data.drop('label', axis=1)
-headers = features.columns
-labels = data['label'].map(LABEL_MAPPING)
-
-config['sequence_length'] = features.shape[1]
-
-config['embedding_dim'] = config['value_embedding_dim'] + config['position_embedding_dim'] + config['amplify_embedding_dim']
-
-# Split data into training and test sets
-X_train, X_test, y_train, y_test = train_test_split(
-    features.values, labels.values, test_size=0.2, random_state=40
-)
+# Streaming preprocessing
+def iter_csv_chunks(input_csv, chunk_size):
+    """
+    Yield (features, labels) NumPy chunks from a CSV without loading the whole file.
+    """
+    for chunk in pd.read_csv(input_csv, chunksize=chunk_size):
+        features = chunk.drop('label', axis=1)
+        labels = chunk['label'].map(LABEL_MAPPING)
+        yield features.to_numpy(), labels.to_numpy()
 
-# Initialize scaler
-scaler = DSRMMCustomScaler(verbose=True)
+def stream_scale_csv(input_csv, scaler, chunk_size, test_size=0.2, random_state=40, output_dir=".", vocabulary=None):
+    """
+    Scale a CSV larger than RAM in two chunked passes.
 
-# Fit scaler on X_train
-scaler.fit(X_train)
-#scaler.fit_quantization(X_train)
+    Pass 1 assigns every row to train/test with a seeded RNG, partial_fits the scaler on the
+    training rows and counts both splits. Pass 2 replays the same split, transforms each chunk
+    to tokens and writes them into preallocated .npy files opened as memmaps. With a
+    TokenVocabulary, pass 2 also fits it on the training tokens, and the written tokens are
+    then re-encoded to compact ids in place, chunk by chunk.
 
-# Save scaling parameters
-scaler.save_scale_dict("scaling_parameters.json")
+    Returns:
+        X_train, X_test, y_train, y_test as read-only memmaps.
+    """
+    token_dtype = np.dtype(config.get('token_dtype', 'int64'))
+    label_dtype = np.dtype(config.get('label_dtype', 'int64'))
+
+    # Pass 1: incremental min/max statistics (its stage time includes reading the CSV chunks)
+    rng = np.random.default_rng(random_state)
+    n_train, n_test, n_features = 0, 0, None
+    with profiler.stage('scaler_fit', streaming=True) as record:
+        for features, labels in tqdm(iter_csv_chunks(input_csv, chunk_size), desc="Fitting scaler", leave=False):
+            is_test = rng.random(len(features)) < test_size
+            scaler.partial_fit(features[~is_test])
+            n_test += int(is_test.sum())
+            n_train += len(features) - int(is_test.sum())
+            n_features = features.shape[1]
+        scaler.save_scale_dict(scaler.params_file)
+        record['samples'] = n_train + n_test
+
+    # Pass 2: transform chunks straight into the preallocated on-disk arrays
+    paths = {name: os.path.join(output_dir, f"{name}.npy") for name in ("X_train_scaled", "X_test_scaled", "y_train", "y_test")}
+    X_train = np.lib.format.open_memmap(paths["X_train_scaled"], mode='w+', dtype=token_dtype, shape=(n_train, n_features))
+    X_test = np.lib.format.open_memmap(paths["X_test_scaled"], mode='w+', dtype=token_dtype, shape=(n_test, n_features))
+    y_train = np.lib.format.open_memmap(paths["y_train"], mode='w+', dtype=label_dtype, shape=(n_train,))
+    y_test = np.lib.format.open_memmap(paths["y_test"], mode='w+', dtype=label_dtype, shape=(n_test,))
+
+    rng = np.random.default_rng(random_state)  # Replay the pass-1 split
+    train_pos, test_pos = 0, 0
+    with profiler.stage('scaler_transform', streaming=True, samples=n_train + n_test):
+        for features, labels in tqdm(iter_csv_chunks(input_csv, chunk_size), desc="Scaling", leave=False):
+            is_test = rng.random(len(features)) < test_size
+            tokens = scaler.transform_tokens(features, dtype=token_dtype)
+            n = len(tokens) - int(is_test.sum())
+            X_train[train_pos:train_pos + n] = tokens[~is_test]
+            if vocabulary is not None:
+                vocabulary.partial_fit(tokens[~is_test])
+            y_train[train_pos:train_pos + n] = labels[~is_test]
+            train_pos += n
+            X_test[test_pos:test_pos + len(tokens) - n] = tokens[is_test]
+            y_test[test_pos:test_pos + len(tokens) - n] = labels[is_test]
+            test_pos += len(tokens) - n
+
+    if vocabulary is not None:
+        with profiler.stage('vocabulary'):
+            vocabulary.save(vocabulary_path(scaler.params_file))
+            for X in (X_train, X_test):
+                for start in range(0, len(X), chunk_size):
+                    vocabulary.encode(X[start:start + chunk_size], out=X[start:start + chunk_size])
+
+    for array in (X_train, X_test, y_train, y_test):
+        array.flush()
+    del X_train, X_test, y_train, y_test
+
+    return tuple(np.load(paths[name], mmap_mode='r') for name in ("X_train_scaled", "X_test_scaled", "y_train", "y_test"))
+
+def scale_csv(input_csv, test_size=0.2, random_state=40, output_dir="."):
+    """
+    Read the whole CSV, split it, fit the scaler (and the token vocabulary) on the training rows,
+    and save the token/label arrays, scaling_parameters.json and token vocabulary to `output_dir`.
+    """
+    with profiler.stage('csv_load') as record:
+        data = pd.read_csv(input_csv)
+        features = data.drop('label', axis=1)
+        labels = data['label'].map(LABEL_MAPPING)
+        record['samples'] = len(data)
+
+    # Split data into training and test sets
+    from sklearn.model_selection import train_test_split
+    X_train, X_test, y_train, y_test = train_test_split(
+        features.values, labels.values, test_size=test_size, random_state=random_state
+    )
+    del data, features, labels
+
+    # Initialize scaler
+    scaler = DSRMMCustomScaler(verbose=True, params_file=os.path.join(output_dir, "scaling_parameters.json"))
+
+    # Fit scaler on X_train (saves the scaling parameters)
+    with profiler.stage('scaler_fit', samples=len(X_train)):
+        scaler.fit(X_train)
+    #scaler.fit_quantization(X_train)
+
+    #Transform X_train and X_test straight to compact integer tokens
+    token_dtype = np.dtype(config.get('token_dtype', 'int64'))
+    label_dtype = np.dtype(config.get('label_dtype', 'int64'))
+    with profiler.stage('scaler_transform', samples=len(X_train) + len(X_test)):
+        X_train_scaled = scaler.transform_tokens(X_train, dtype=token_dtype)
+        X_test_scaled = scaler.transform_tokens(X_test, dtype=token_dtype)
+
+    # Compact vocabulary: fit the per-column token dictionary on the training tokens and re-encode both splits
+    if config.get('compact_vocabulary', False):
+        with profiler.stage('vocabulary'):
+            vocabulary = TokenVocabulary().fit(X_train_scaled)
+            vocabulary.save(vocabulary_path(scaler.params_file))
+            X_train_scaled = vocabulary.encode(X_train_scaled, dtype=token_dtype)
+            X_test_scaled = vocabulary.encode(X_test_scaled, dtype=token_dtype)
+        print(f"Compact vocabulary: {vocabulary.num_tokens} tokens, {vocabulary.num_rows} embedding rows (of {config['vocab_size']})")
+
+    # Save the scaled data to disk
+    with profiler.stage('save_tokens'):
+        np.save(os.path.join(output_dir, "X_train_scaled.npy"), X_train_scaled)
+        np.save(os.path.join(output_dir, "X_test_scaled.npy"), X_test_scaled)
+        np.save(os.path.join(output_dir, "y_train.npy"), y_train.astype(label_dtype))
+        np.save(os.path.join(output_dir, "y_test.npy"), y_test.astype(label_dtype))
+    print("Saved X_train_scaled and X_test_scaled to disk.")
+
+def fold_duplicates(tokens, labels, weights=None):
+    """
+    Group identical (token row, label) pairs. Returns the distinct rows, their labels, and how often each occurred.
+    With `weights`, each input row counts `weights[i]` times (used to merge already-folded chunks).
+    """
+    pairs = np.ascontiguousarray(np.column_stack((tokens, labels.astype(tokens.dtype))))
+    rows = pairs.view(np.dtype((np.void, pairs.dtype.itemsize * pairs.shape[1]))).ravel()
+    _, first, inverse, counts = np.unique(rows, return_index=True, return_inverse=True, return_counts=True)
+    if weights is not None:
+        counts = np.bincount(inverse.ravel(), weights=weights, minlength=len(first)).astype(np.int64)
+    order = np.argsort(first)  # Keep the distinct pairs in order of first occurrence
+    return tokens[first[order]], labels[first[order]], counts[order]
+
+def write_weighted_unique(directory, split, chunk_rows=None):
+    """
+    Save the distinct (row, label) pairs of one split as X_<split>_unique.npy / y_<split>_unique.npy
+    plus their counts as <split>_counts.npy.
 
-#Transform X_train and X_test
-X_train_scaled = scaler.transform(X_train)
-X_test_scaled = scaler.transform(X_test)
+    The memory-mapped split is folded `chunk_rows` rows at a time (config['chunk_size'] by default)
+    and merged into the running distinct set, so memory grows with the distinct rows, not the split.
+    """
+    chunk_rows = chunk_rows or config['chunk_size']
+    tokens = np.load(os.path.join(directory, f"X_{split}_scaled.npy"), mmap_mode='r')
+    labels = np.load(os.path.join(directory, f"y_{split}.npy"), mmap_mode='r')
+    unique_tokens = tokens[:0].copy()
+    unique_labels = labels[:0].copy()
+    counts = np.zeros(0, dtype=np.int64)
+    for start in range(0, len(labels), chunk_rows):
+        chunk_tokens, chunk_labels, chunk_counts = fold_duplicates(
+            np.asarray(tokens[start:start + chunk_rows]), np.asarray(labels[start:start + chunk_rows])
+        )
+        # Running set first, so the merged pairs stay in order of first occurrence
+        unique_tokens, unique_labels, counts = fold_duplicates(
+            np.concatenate((unique_tokens, chunk_tokens)), np.concatenate((unique_labels, chunk_labels)),
+            weights=np.concatenate((counts, chunk_counts))
+        )
+    np.save(os.path.join(directory, f"X_{split}_unique.npy"), unique_tokens)
+    np.save(os.path.join(directory, f"y_{split}_unique.npy"), unique_labels)
+    np.save(os.path.join(directory, f"{split}_counts.npy"), counts.astype(np.int32))
+    print(f"Weighted-unique {split} split: {len(counts)} distinct rows of {len(labels)}")
+
+# Preprocessing cache
+PREPROCESS_VERSION = 1  # Bump when the preprocessing code changes what it writes
+PREPROCESS_CONFIG_KEYS = (
+    'lower_bound', 'upper_bound', 'ushirk', 'lshirk', 'threshold', 'vocab_size', 'nearest_neighbour',
+    'token_dtype', 'label_dtype', 'streaming', 'compact_vocabulary', 'weighted_unique',
+)
 
-# If X_train_scaled and X_test_scaled are pandas DataFrames, convert them to NumPy arrays
-if isinstance(X_train_scaled, pd.DataFrame):
-    X_train_scaled = X_train_scaled.to_numpy()
-if isinstance(X_test_scaled, pd.DataFrame):
-    X_test_scaled = X_test_scaled.to_numpy()
+def file_digest(path, block_size=1 << 20):
+    """SHA-256 of a file's contents, read in blocks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
 
-# 2. Save the scaled data to disk
-np.save("X_train_scaled.npy", X_train_scaled)
-np.save("X_test_scaled.npy", X_test_scaled)
+def preprocessing_key(input_csv, test_size, random_state):
+    """
+    Content address of the preprocessing artifacts: the CSV's hash, the config values the scaler
+    and vocabulary depend on, the split, and LABEL_MAPPING. Returns (key, manifest fields).
+    """
+    fields = {
+        'version': PREPROCESS_VERSION,
+        'csv_sha256': file_digest(input_csv),
+        'config': {name: config.get(name) for name in PREPROCESS_CONFIG_KEYS},
+        'test_size': test_size,
+        'random_state': random_state,
+        'label_mapping': LABEL_MAPPING,
+    }
+    return hashlib.sha256(json.dumps(fields, sort_keys=True).encode()).hexdigest()[:16], fields
+
+def publish_artifacts(directory, names, target_dir="."):
+    """
+    Expose cached artifacts under their usual names in `target_dir` (hard links, or copies where
+    links are not supported), replacing whatever a previous run left there.
+    """
+    for name in names:
+        source, target = os.path.join(directory, name), os.path.join(target_dir, name)
+        if os.path.exists(target) and os.path.samefile(source, target):
+            continue
+        staging = f"{target}.tmp-{os.getpid()}"
+        try:
+            os.link(source, staging)
+        except OSError:
+            shutil.copyfile(source, staging)
+        os.replace(staging, target)
 
-print("Saved X_train_scaled and X_test_scaled to disk.")
+def prepare_datasets(input_csv, test_size=0.2, random_state=40):
+    """
+    Scaled token/label .npy files for the train and test splits, as (train_paths, test_paths).
+    With 'weighted_unique' each split is its distinct (row, label) pairs plus a counts file.
 
-# 3. Load the saved data from disk
-X_train_loaded = np.load("X_train_scaled.npy")
-X_test_loaded = np.load("X_test_scaled.npy")
+    With 'preprocess_cache' the artifacts live in cache_dir/<key>, keyed by preprocessing_key; a hit
+    skips reading the CSV and fitting the scaler. A miss preprocesses into a staging directory that
+    is renamed into place once complete, so an interrupted run never leaves a half-written entry.
+    The arrays, scaling parameters and vocabulary are also linked into the working directory.
+    """
+    names = ["X_train_scaled.npy", "X_test_scaled.npy", "y_train.npy", "y_test.npy", "scaling_parameters.json"]
+    if config.get('compact_vocabulary', False):
+        names.append(config['vocabulary_file'])
+    weighted = config.get('weighted_unique', False)
+    if weighted:
+        names += [f"{prefix}{split}{suffix}" for split in ("train", "test")
+                  for prefix, suffix in (("X_", "_unique.npy"), ("y_", "_unique.npy"), ("", "_counts.npy"))]
+
+    output_dir, staging_dir = ".", None
+    if config.get('preprocess_cache', False):
+        key, fields = preprocessing_key(input_csv, test_size, random_state)
+        output_dir = os.path.join(config['cache_dir'], key)
+        if os.path.exists(os.path.join(output_dir, "manifest.json")):
+            print(f"Preprocessing cache hit: {output_dir}")
+        else:
+            staging_dir = f"{output_dir}.tmp-{os.getpid()}"
+            os.makedirs(staging_dir, exist_ok=True)
+
+    if output_dir == ".":
+        # Earlier cached runs may have left hard links here; writing through them would corrupt the cache
+        for name in names:
+            if os.path.exists(name):
+                os.remove(name)
+    if output_dir == "." or staging_dir is not None:
+        target_dir = staging_dir or "."
+        if config.get('streaming', False):
+            # Chunked ingestion: scaled tokens are written to disk and memory-mapped back
+            scaler = DSRMMCustomScaler(verbose=False, params_file=os.path.join(target_dir, "scaling_parameters.json"))
+            vocabulary = TokenVocabulary() if config.get('compact_vocabulary', False) else None
+            stream_scale_csv(
+                input_csv, scaler, config['chunk_size'], test_size=test_size, random_state=random_state,
+                output_dir=target_dir, vocabulary=vocabulary
+            )
+        else:
+            scale_csv(input_csv, test_size=test_size, random_state=random_state, output_dir=target_dir)
+        if weighted:
+            # Fold duplicate (row, label) pairs into distinct rows with counts
+            with profiler.stage('fold_duplicates'):
+                for split in ("train", "test"):
+                    write_weighted_unique(target_dir, split)
+
+    if staging_dir is not None:
+        with open(os.path.join(staging_dir, "manifest.json"), "w") as f:
+            json.dump(fields, f, indent=4)
+        try:
+            os.replace(staging_dir, output_dir)
+        except OSError:
+            shutil.rmtree(staging_dir)  # Another run committed the same key first
+        print(f"Preprocessing cached in {output_dir}")
+    if output_dir != ".":
+        publish_artifacts(output_dir, names)
+
+    config['sequence_length'] = np.load(os.path.join(output_dir, "X_train_scaled.npy"), mmap_mode='r').shape[1]
+    if weighted:
+        train_paths, test_paths = (
+            tuple(os.path.join(output_dir, name) for name in (f"X_{split}_unique.npy", f"y_{split}_unique.npy", f"{split}_counts.npy"))
+            for split in ("train", "test")
+        )
+    else:
+        train_paths = (os.path.join(output_dir, "X_train_scaled.npy"), os.path.join(output_dir, "y_train.npy"))
+        test_paths = (os.path.join(output_dir, "X_test_scaled.npy"), os.path.join(output_dir, "y_test.npy"))
+    return train_paths, test_paths
 
-print("Loaded X_train_scaled from disk. Shape:", X_train_loaded.shape)
-print("Loaded X_test_scaled from disk. Shape:", X_test_loaded.shape)
+# Token Dataset
+class TokenDataset(Dataset):
+    """
+    Dataset over memory-mapped token and label .npy files.
 
-# Continue with tensor conversion after confirming the load process works
-train_dataset = TensorDataset(
-    torch.tensor(X_train_loaded, dtype=torch.long),  # Convert to long for labels
-    torch.tensor(y_train, dtype=torch.long)  # Labels as long (int64)
-)
-test_dataset = TensorDataset(
-    torch.tensor(X_test_loaded, dtype=torch.long),  # Convert to long for labels
-    torch.tensor(y_test, dtype=torch.long)  # Labels as long (int64)
-)
+    Indexing accepts an int, a slice or an array of indices, so a whole batch is gathered
+    with one NumPy slice/fancy-index instead of one __getitem__ call per sample. The memmaps
+    are opened lazily, which keeps the dataset cheap to pickle into DataLoader workers.
+    With `counts_path` (weighted-unique data) every item also carries its duplicate count.
+    """
+    def __init__(self, tokens_path, labels_path, counts_path=None):
+        self.tokens_path = tokens_path
+        self.labels_path = labels_path
+        self.counts_path = counts_path
+        self.tokens = None
+        self.labels = None
+        self.counts = None
+        self.num_samples = len(np.load(labels_path, mmap_mode='r'))
+
+    def open(self):
+        if self.tokens is None:
+            self.tokens = np.load(self.tokens_path, mmap_mode='r')
+            self.labels = np.load(self.labels_path, mmap_mode='r')
+            if self.counts_path is not None:
+                self.counts = np.load(self.counts_path, mmap_mode='r')
+
+    def __len__(self):
+        return self.num_samples
+
+    def __getitem__(self, index):
+        self.open()
+        if not isinstance(index, (slice, int, np.integer)):
+            # Sorted indices read the memmap in file order; the batch is a set, so order does not matter
+            index = np.sort(np.asarray(index))
+        tokens = np.array(self.tokens[index])  # Copy out of the page cache into a writable batch
+        labels = np.array(self.labels[index], dtype=np.int64)
+        if self.counts is not None:
+            counts = np.array(self.counts[index], dtype=np.int64)
+            return torch.from_numpy(tokens), torch.from_numpy(labels), torch.from_numpy(counts)
+        return torch.from_numpy(tokens), torch.from_numpy(labels)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['tokens'] = None  # Reopen the memmaps in the receiving process
+        state['labels'] = None
+        state['counts'] = None
+        return state
+
+class TokenBatchSampler(Sampler):
+    """
+    Yield whole batches of indices for TokenDataset.
 
-# Prepare DataLoader
-train_loader = DataLoader(train_dataset, batch_size=config['batch_size'], shuffle=True, pin_memory=True)
-test_loader = DataLoader(test_dataset, batch_size=config['batch_size'], shuffle=False, pin_memory=True)
+    Without shuffling the batches are contiguous slices (zero-copy memmap reads); with shuffling
+    each batch is a block of a random permutation, gathered by the dataset in one fancy-index.
+    The permutation depends only on (seed, epoch), so a resumed run can replay an epoch and
+    skip the batches it already trained on.
+    """
+    def __init__(self, num_samples, batch_size, shuffle=False, drop_last=False, seed=None):
+        self.num_samples = num_samples
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed if seed is not None else np.random.SeedSequence().entropy
+        self.epoch = 0
+        self.skip_batches = 0
+
+    def set_epoch(self, epoch, skip_batches=0):
+        """
+        Select the permutation of `epoch` for the next iteration and start it after `skip_batches` batches.
+        """
+        self.epoch = epoch
+        self.skip_batches = skip_batches
+
+    def __len__(self):
+        if self.drop_last:
+            return self.num_samples // self.batch_size
+        return math.ceil(self.num_samples / self.batch_size)
+
+    def __iter__(self):
+        # Each pass advances the epoch, so callers that never call set_epoch still get a new order every epoch
+        epoch, skip = self.epoch, self.skip_batches
+        self.epoch, self.skip_batches = epoch + 1, 0
+        order = np.random.default_rng([self.seed, epoch]).permutation(self.num_samples) if self.shuffle else None
+        for i in range(skip, len(self)):
+            start, stop = i * self.batch_size, min((i + 1) * self.batch_size, self.num_samples)
+            yield order[start:stop] if order is not None else slice(start, stop)
+
+def stratified_order(labels, seed=None):
+    """
+    Permutation of range(len(labels)) whose every prefix is (approximately) stratified by label,
+    so growing fractions of the data are nested subsets with the full label mix.
+    """
+    labels = np.asarray(labels)
+    rng = np.random.default_rng(seed)
+    rank = np.empty(len(labels), dtype=np.float64)
+    for label in np.unique(labels):
+        members = np.flatnonzero(labels == label)
+        # Spread each class evenly over [0, 1) in random order, then interleave the classes by position
+        rank[rng.permutation(members)] = (np.arange(len(members)) + rng.random(len(members))) / len(members)
+    return np.argsort(rank, kind='stable')
+
+class BackgroundPrefetcher:
+    """
+    Iterate a DataLoader on a background thread, pinning batches and copying them to `device`
+    ahead of time so the training loop never waits on data.
+    """
+    _END = object()
+
+    def __init__(self, loader, device, num_batches=2):
+        self.loader = loader
+        self.dataset = loader.dataset
+        self.device = device
+        self.num_batches = num_batches
+
+    def __len__(self):
+        return len(self.loader)
+
+    def transfer(self, tensor):
+        if self.device.type != 'cuda':
+            return tensor
+        if not tensor.is_pinned():
+            tensor = tensor.pin_memory()
+        return tensor.to(self.device, non_blocking=True)
+
+    def __iter__(self):
+        batches = queue.Queue(maxsize=self.num_batches)
+        stop = threading.Event()
+
+        def put(item):
+            # Give up when the consumer has stopped iterating (e.g. a pruned trial)
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def produce():
+            try:
+                for batch in self.loader:
+                    if not put(tuple(self.transfer(t) for t in batch)):
+                        return
+                put(self._END)
+            except Exception as e:
+                put(e)
+
+        worker = threading.Thread(target=produce, daemon=True)
+        worker.start()
+        try:
+            while True:
+                item = batches.get()
+                if item is self._END:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+
+def loader_sampler(loader):
+    """The TokenBatchSampler behind a loader built by build_loader."""
+    return getattr(loader, 'loader', loader).sampler
+
+def build_loader(dataset, shuffle):
+    """
+    Build a DataLoader over batch-indexable `dataset` using the loader settings in `config`.
+    """
+    num_workers = config.get('num_workers', 0)
+    sampler = TokenBatchSampler(len(dataset), config['batch_size'], shuffle=shuffle)
+    loader = DataLoader(
+        dataset,
+        sampler=sampler,
+        batch_size=None,  # The sampler already yields whole batches; skip per-sample collation
+        # Own generator for the worker base seed, so starting an epoch never draws from the global torch RNG
+        generator=torch.Generator().manual_seed(int(sampler.seed) % 2**63),
+        num_workers=num_workers,
+        persistent_workers=config.get('persistent_workers', False) and num_workers > 0,
+        prefetch_factor=config.get('prefetch_factor', 2) if num_workers > 0 else None,
+        pin_memory=config.get('pin_memory', True) and device.type == 'cuda',
+    )
+    if config.get('background_prefetch', False):
+        return BackgroundPrefetcher(loader, device, config.get('prefetch_batches', 2))
+    return loader
 
 class GraphAvgColAmplifiedEmbedding(nn.Module):
     def __init__(
@@ -612,6 +1494,8 @@ class GraphAvgColAmplifiedEmbedding(nn.Module):
         k=config.get('nearest_neighbour'),  # Number of nearest rows
         num_graph_layers=config.get('num_graph_layers'),
         dropout_prob=0.3,
+        window_rows=None,  # TokenVocabulary.window_rows: inputs are compact ids instead of raw tokens
+        sparse=False,  # Sparse value-embedding gradients (pair with SplitOptimizer)
     ):
         super(GraphAvgColAmplifiedEmbedding, self).__init__()
 
@@ -622,8 +1506,15 @@ class GraphAvgColAmplifiedEmbedding(nn.Module):
         # Combined feature dimension (d_v + d_p)
         self.input_feature_dim = value_embedding_dim + position_embedding_dim
 
+        # Compact vocabulary: window_rows[id] lists the value-embedding rows of that token's window,
+        # so only the rows some observed window reaches are stored
+        if window_rows is not None:
+            window_rows = torch.as_tensor(window_rows, dtype=torch.long)
+        self.register_buffer('window_rows', window_rows)
+        num_rows = int(window_rows.max()) + 1 if window_rows is not None else vocab_size
+
         # Value and position embeddings
-        self.value_embedding = nn.Embedding(vocab_size, value_embedding_dim)  # E_v
+        self.value_embedding = nn.Embedding(num_rows, value_embedding_dim, sparse=sparse)  # E_v
         self.position_embedding = nn.Embedding(sequence_length, position_embedding_dim)  # E_p
 
         # Graph-based amplification embeddings
@@ -648,54 +1539,135 @@ class GraphAvgColAmplifiedEmbedding(nn.Module):
         nn.init.xavier_uniform_(self.position_embedding.weight)
         nn.init.xavier_uniform_(self.value_embedding.weight)
 
-    def forward(self, discrete_indices):
-        batch_size, seq_len = discrete_indices.size()
+        # Neighbor window [index + low, index + high], same offsets as torch.arange(-k // 2, k // 2 + 1)
+        self.window_low = -self.k // 2
+        self.window_high = self.k // 2
 
-        # Step 1: Map input indices to column-constrained neighbors
-        rounded_indices = discrete_indices.round()  # Round to integer
+        # Tensors derived from parameters, cached while no gradient is needed (see eval_cache)
+        self.cache = {}
+
+    def neighbour_indices(self, discrete_indices):
+        """
+        Map input indices to their clamped neighbor window: [batch_size, seq_len, window].
+        """
+        if self.window_rows is not None:
+            return self.window_rows[discrete_indices.long().clamp(0, self.window_rows.size(0) - 1)]
+        rounded_indices = discrete_indices.round().long()  # Round to integer
         nearest_offsets = torch.arange(
-            -self.k // 2, self.k // 2 + 1, device=discrete_indices.device
-        ).unsqueeze(0)  # [1, k]
+            self.window_low, self.window_high + 1, device=discrete_indices.device
+        ).unsqueeze(0)  # [1, window]
 
         # Constrain neighbor indices within columns (same sequence index)
-        nearest_indices = nearest_offsets + rounded_indices.unsqueeze(-1)  # [batch_size, seq_len, k]
-        nearest_indices = nearest_indices.clamp(0, self.vocab_size - 1)  # Clip to valid range
+        nearest_indices = nearest_offsets + rounded_indices.unsqueeze(-1)  # [batch_size, seq_len, window]
+        return nearest_indices.clamp(0, self.vocab_size - 1)  # Clip to valid range
 
-        # Step 2: Gather column-constrained embeddings and compute the average
-        # Only gather embeddings for the same sequence position (column constraint)
-        nearest_embeddings = self.value_embedding(nearest_indices)  # [batch_size, seq_len, k, value_embedding_dim]
-        value_embeddings = nearest_embeddings.mean(dim=-2)  # Average pooling within column neighbors
+    def neighbour_average_reference(self, discrete_indices):
+        """
+        Reference lookup: gather every neighbor row, then average. Kept for parity checks.
+        """
+        nearest_embeddings = self.value_embedding(self.neighbour_indices(discrete_indices))  # [batch_size, seq_len, window, value_embedding_dim]
+        return nearest_embeddings.mean(dim=-2)
 
-        # Step 3: Compute position embeddings
-        position_ids = torch.arange(seq_len, device=discrete_indices.device).unsqueeze(0).repeat(batch_size, 1)
-        position_embeddings = self.position_embedding(position_ids)  # [batch_size, seq_len, position_embedding_dim]
+    def eval_cache(self, name, source, build):
+        """
+        Return build(), cached while no gradient is needed (evaluation/inference).
+        The entry is rebuilt whenever `source` is moved or updated in place, e.g. by an optimizer step.
+        """
+        if torch.is_grad_enabled():
+            return build()
+        key = (source.data_ptr(), source._version)
+        cached = self.cache.get(name)
+        if cached is None or cached[0] != key:
+            cached = (key, build())
+            self.cache[name] = cached
+        return cached[1]
+
+    def build_window_table(self):
+        """
+        Precompute the neighbor-averaged embedding of every reachable index with one prefix sum.
 
-        # Combine value and position embeddings as node features
-        node_features = torch.cat((value_embeddings, position_embeddings), dim=-1)  # [batch_size, seq_len, d_v + d_p]
+        Row t + window_high holds the mean of value_embedding rows clamp(t + window_low .. t + window_high)
+        for t in [-window_high, vocab_size - 1 - window_low]; indices outside that range see the same
+        clamped window as the nearest end, so every lookup becomes a single O(1) row gather.
+        """
+        weight = self.value_embedding.weight.detach()
+        if self.window_rows is not None:
+            # Compact vocabulary: row t is the mean of the rows listed for compact id t
+            return F.embedding_bag(self.window_rows, weight, mode='mean')
+        window = self.window_high - self.window_low + 1
+
+        # Pad with the edge rows so clamped neighbors are counted exactly as often as in the gather
+        padded = torch.cat((
+            weight[:1].expand(window - 1, -1), weight, weight[-1:].expand(window - 1, -1)
+        )).double()
+        prefix = torch.cat((padded.new_zeros(1, padded.size(1)), padded.cumsum(dim=0)))
+        table_size = self.vocab_size + window - 1
+        return ((prefix[window:window + table_size] - prefix[:table_size]) / window).to(weight.dtype)
+
+    def neighbour_average(self, discrete_indices):
+        """
+        Mean of the clamped neighbor window of every index, without materializing the gathered rows.
 
-        # Step 4: Amplify embeddings using graph layers
-        amplified_embeddings = node_features  # Initialize with F_0
-        adjacency_matrix = F.softmax(self.adjacency_weights, dim=-1)  # Normalize adjacency matrix
-        adjacency_matrix = adjacency_matrix.unsqueeze(0).expand(batch_size, -1, -1)  # [batch_size, seq_len, seq_len]
+        Only the no-grad path is O(1) per token (one row of the cached build_window_table). Training
+        still reads all k window rows per token through embedding_bag: a differentiable prefix sum
+        would rescan the whole table every step and make its gradient dense, which measured far slower.
+        """
+        if torch.is_grad_enabled():
+            # Training: fixed-size bags averaged by embedding_bag, so no [batch, seq, window, dim] tensor
+            nearest_indices = self.neighbour_indices(discrete_indices)
+            bags = F.embedding_bag(
+                nearest_indices.view(-1, nearest_indices.size(-1)), self.value_embedding.weight, mode='mean',
+                sparse=self.value_embedding.sparse
+            )
+            return bags.view(*discrete_indices.shape, -1)
 
-        for i, layer in enumerate(self.graph_layers):
-            # Propagate embeddings with adjacency matrix
+        # No gradient needed: one gather from the cached window table
+        window_table = self.eval_cache('window_table', self.value_embedding.weight, self.build_window_table)
+        return F.embedding(self.table_indices(discrete_indices), window_table)
+
+    def table_indices(self, discrete_indices):
+        """
+        Row of build_window_table() for every index.
+        """
+        if self.window_rows is not None:
+            return discrete_indices.long().clamp(0, self.window_rows.size(0) - 1)
+        return discrete_indices.round().long().clamp(-self.window_high, self.vocab_size - 1 - self.window_low) + self.window_high
+
+    def amplify(self, node_features):
+        """
+        Propagate node features through the graph layers with one shared [seq_len, seq_len] adjacency.
+        """
+        adjacency_matrix = self.eval_cache(
+            'adjacency', self.adjacency_weights, lambda: F.softmax(self.adjacency_weights, dim=-1)
+        )  # Normalize adjacency matrix
+
+        # One stride-0 view of the shared matrix serves every layer; expand allocates nothing. A broadcast
+        # matmul or einsum over the [seq_len, seq_len] matrix measured no faster, and slower to backpropagate
+        adjacency_matrix = adjacency_matrix.expand(node_features.size(0), -1, -1)  # [batch_size, seq_len, seq_len]
+
+        amplified_embeddings = node_features  # Initialize with F_0
+        for layer in self.graph_layers:
+            # Propagate embeddings with the shared adjacency matrix
             amplified_embeddings = torch.bmm(adjacency_matrix, amplified_embeddings)  # [batch_size, seq_len, d_v + d_p or amplify_embedding_dim]
 
-            # Ensure the graph layer expects the correct input dimension
-            expected_input_dim = layer.in_features
-            assert amplified_embeddings.size(-1) == expected_input_dim, (
-                f"Mismatch in dimensions: expected {expected_input_dim}, got {amplified_embeddings.size(-1)}"
-            )
+            # Apply the graph layer, activation and dropout for regularization
+            amplified_embeddings = self.dropout(F.relu(layer(amplified_embeddings)))
+        return amplified_embeddings
 
-            # Apply the graph layer
-            amplified_embeddings = layer(amplified_embeddings)
+    def forward(self, discrete_indices):
+        batch_size, seq_len = discrete_indices.size()
 
-            # Apply activation function
-            amplified_embeddings = F.relu(amplified_embeddings)
+        # Step 1-2: Average the column-constrained neighbor embeddings of every index
+        value_embeddings = self.neighbour_average(discrete_indices)  # [batch_size, seq_len, value_embedding_dim]
 
-            # Apply dropout for regularization
-            amplified_embeddings = self.dropout(amplified_embeddings)
+        # Step 3: Position ids are always 0..seq_len-1, so slice the table and broadcast it over the batch
+        position_embeddings = self.position_embedding.weight[:seq_len].unsqueeze(0).expand(batch_size, -1, -1)  # [batch_size, seq_len, position_embedding_dim]
+
+        # Combine value and position embeddings as node features
+        node_features = torch.cat((value_embeddings, position_embeddings), dim=-1)  # [batch_size, seq_len, d_v + d_p]
+
+        # Step 4: Amplify embeddings using graph layers
+        amplified_embeddings = self.amplify(node_features)
 
         # Step 5: Concatenate all embeddings
         final_embeddings = torch.cat(
@@ -736,11 +1708,49 @@ def random_landmark_sampling(Q, m):
     batch_size, seq_len, d_k = Q.size()
     m = min(m, seq_len)  # Ensure m does not exceed seq_len
 
-    # Randomly sample indices without replacement
-    indices = torch.randint(0, seq_len, (batch_size, m), device=Q.device)
+    # Randomly sample indices without replacement (first m positions of a random permutation per row)
+    indices = torch.rand(batch_size, seq_len, device=Q.device).argsort(dim=1)[:, :m]
     Q_landmarks = torch.gather(Q, 1, indices.unsqueeze(-1).expand(-1, -1, Q.size(-1)))
     return Q_landmarks, indices
 
+LANDMARK_SAMPLERS = {
+    'max_norm': max_norm_landmark_sampling,
+    'random': random_landmark_sampling,
+}
+
+def nystrom_attention(query_layer, key_layer, value_layer, attention_mask, num_landmarks, sampler, pinv_rtol, dropout):
+    """
+    Approximate softmax(Q K^T) V with m landmarks as
+    softmax(Q K_m^T) pinv(softmax(Q_m K_m^T)) softmax(Q_m K^T) V, which never builds a seq x seq matrix.
+    Inputs are [batch, seq_len, d]; attention_mask is the additive [batch, seq_len] mask or None.
+    """
+    scale = math.sqrt(query_layer.size(-1))
+    # Landmarks are picked on the queries; the matching key rows use the same positions
+    landmark_queries, indices = sampler(query_layer, num_landmarks)
+    landmark_keys = torch.gather(key_layer, 1, indices.unsqueeze(-1).expand(-1, -1, key_layer.size(-1)))
+
+    kernel_to_landmarks = torch.matmul(query_layer, landmark_keys.transpose(-1, -2)) / scale  # [batch_size, seq_len, m]
+    kernel_landmarks = torch.matmul(landmark_queries, landmark_keys.transpose(-1, -2)) / scale  # [batch_size, m, m]
+    kernel_from_landmarks = torch.matmul(landmark_queries, key_layer.transpose(-1, -2)) / scale  # [batch_size, m, seq_len]
+
+    if attention_mask is not None:
+        landmark_mask = torch.gather(attention_mask, 1, indices).unsqueeze(1)  # Shape [batch_size, 1, m]
+        kernel_to_landmarks = kernel_to_landmarks + landmark_mask
+        kernel_landmarks = kernel_landmarks + landmark_mask
+        kernel_from_landmarks = kernel_from_landmarks + attention_mask.unsqueeze(1)
+
+    kernel_to_landmarks = dropout(torch.softmax(kernel_to_landmarks, dim=-1))
+    kernel_landmarks = torch.softmax(kernel_landmarks, dim=-1)
+    kernel_landmarks = torch.linalg.pinv(
+        kernel_landmarks.float(), rtol=pinv_rtol
+    ).to(kernel_landmarks.dtype)  # pinv has no half-precision kernels
+    kernel_from_landmarks = torch.softmax(kernel_from_landmarks, dim=-1)
+
+    # Multiply right to left so every intermediate stays [*, m, d]
+    context_layer = torch.matmul(kernel_from_landmarks, value_layer)  # Shape: [batch_size, m, d]
+    context_layer = torch.matmul(kernel_landmarks, context_layer)
+    return torch.matmul(kernel_to_landmarks, context_layer)  # Shape: [batch_size, seq_len, d]
+
 #Anomaly Aware SelfAttention
 
 class AnomalyAwareSelfAttention(nn.Module):
@@ -762,6 +1772,14 @@ class AnomalyAwareSelfAttention(nn.Module):
         self.anomaly_matrix = nn.Parameter(torch.zeros(self.hidden_size, self.hidden_size))
         self.threshold = nn.Parameter(torch.tensor(1.0))
 
+        # Optional landmark (Nystrom) approximation of the attention matrix
+        self.attention_mode = config.get('attention_mode', 'exact')
+        self.num_landmarks = config.get('num_landmarks', 16)
+        self.landmark_sampler = LANDMARK_SAMPLERS[config.get('landmark_sampler', 'max_norm')]
+        self.landmark_pinv_rtol = config.get('landmark_pinv_rtol', 1e-2)
+        if self.attention_mode not in ('exact', 'nystrom'):
+            raise ValueError(f"Unknown attention_mode {self.attention_mode!r}, expected 'exact' or 'nystrom'.")
+
         # Initialize weights
         self.init_weights()
 
@@ -778,6 +1796,13 @@ class AnomalyAwareSelfAttention(nn.Module):
         # Initialize anomaly matrix with small random values for stability
         nn.init.uniform_(self.anomaly_matrix, a=-2.0, b=2.0)
 
+    def nystrom_context(self, query_layer, transformed_query, value_layer, attention_mask=None):
+        """
+        Landmark approximation of the attention context, see nystrom_attention.
+        """
+        return nystrom_attention(query_layer, transformed_query, value_layer, attention_mask, self.num_landmarks,
+                                 self.landmark_sampler, self.landmark_pinv_rtol, self.dropout)
+
     def forward(self, hidden_states, attention_mask=None):
         """
         Forward pass for anomaly-aware self-attention, capturing magnitude sensitivity.
@@ -801,6 +1826,10 @@ class AnomalyAwareSelfAttention(nn.Module):
         # Anomaly transformation: apply anomaly matrix to query_layer
         transformed_query = torch.matmul(query_layer, self.anomaly_matrix)  # Shape: [batch_size, seq_len, hidden_size]
 
+        if self.attention_mode == 'nystrom' and self.num_landmarks < seq_len:
+            context_layer = self.nystrom_context(query_layer, transformed_query, value_layer, attention_mask)
+            return context_layer * input_norm
+
         # Compute magnitude-sensitive attention scores
         anomaly_scores = torch.matmul(query_layer, transformed_query.transpose(-1, -2)) / math.sqrt(self.hidden_size)
         # Shape of anomaly_scores: [batch_size, seq_len, seq_len]
@@ -843,10 +1872,178 @@ class StackedSelfAttention(nn.Module):
         
         return hidden_states
 
+class MultiHeadAnomalyAwareSelfAttention(nn.Module):
+    """
+    Several parallel AnomalyAwareSelfAttention modules packed into batched weights.
+
+    All heads read the same input, so the query/value projections of every head run as one packed
+    Linear and the seq x seq attention of every head as one set of batched matmuls. The output is
+    the heads concatenated on the last dimension, like StackedSelfAttention's torch.cat. With
+    attention_mode 'nystrom' the heads are folded into the batch and each picks its own landmarks,
+    as the separate modules would. A state dict saved with the per-module layout
+    ("{head}.query.weight", ...) loads directly.
+    """
+    def __init__(self, config, num_heads=None):
+        super(MultiHeadAnomalyAwareSelfAttention, self).__init__()
+
+        self.hidden_size = config['hidden_size']
+        self.num_heads = num_heads or config['num_attention_heads']
+        self.attention_probs_dropout_prob = config['attention_probs_dropout_prob']
+        # The anomaly score is q (q A)^T / sqrt(d), i.e. scaled dot-product attention with keys q A
+        self.use_sdpa = config.get('attention_sdpa', False)
+
+        # Same landmark (Nystrom) options as AnomalyAwareSelfAttention; each head picks its own landmarks
+        self.attention_mode = config.get('attention_mode', 'exact')
+        self.num_landmarks = config.get('num_landmarks', 16)
+        self.landmark_sampler = LANDMARK_SAMPLERS[config.get('landmark_sampler', 'max_norm')]
+        self.landmark_pinv_rtol = config.get('landmark_pinv_rtol', 1e-2)
+        if self.attention_mode not in ('exact', 'nystrom'):
+            raise ValueError(f"Unknown attention_mode {self.attention_mode!r}, expected 'exact' or 'nystrom'.")
+
+        # Query (index 0) and value (index 1) weights of every head packed as one Linear ([out, in] per head)
+        self.projection_weight = nn.Parameter(torch.empty(2, self.num_heads, self.hidden_size, self.hidden_size))
+        self.projection_bias = nn.Parameter(torch.zeros(2, self.num_heads, self.hidden_size))
+        self.anomaly_matrix = nn.Parameter(torch.zeros(self.num_heads, self.hidden_size, self.hidden_size))
+        self.threshold = nn.Parameter(torch.ones(self.num_heads))
+
+        # Dropout layer for attention probabilities
+        self.dropout = nn.Dropout(self.attention_probs_dropout_prob)
+
+        self.init_weights()
+        self.register_load_state_dict_pre_hook(self.pack_module_state_dict)
+
+    def init_weights(self):
+        """
+        Same initialization as AnomalyAwareSelfAttention, applied head by head.
+        """
+        gain = 1.2 # 1.0 for gelu
+        with torch.no_grad():
+            for weight in self.projection_weight.view(-1, self.hidden_size, self.hidden_size):
+                nn.init.xavier_uniform_(weight, gain=gain)
+        nn.init.zeros_(self.projection_bias)
+        nn.init.uniform_(self.anomaly_matrix, a=-2.0, b=2.0)
+
+    @staticmethod
+    def pack_module_state_dict(module, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+        """
+        load_state_dict pre-hook: stack per-module AnomalyAwareSelfAttention keys into the packed layout.
+        """
+        per_module = {
+            'projection_weight': ('query.weight', 'value.weight'),
+            'projection_bias': ('query.bias', 'value.bias'),
+            'anomaly_matrix': ('anomaly_matrix',),
+            'threshold': ('threshold',),
+        }
+        for packed_name, module_names in per_module.items():
+            keys = [[f"{prefix}{head}.{name}" for head in range(module.num_heads)] for name in module_names]
+            if all(key in state_dict for group in keys for key in group):
+                packed = torch.stack([torch.stack([state_dict.pop(key) for key in group]) for group in keys])
+                state_dict[prefix + packed_name] = packed if len(module_names) > 1 else packed[0]
+
+    @classmethod
+    def from_attention_modules(cls, attentions, config):
+        """
+        Build a fused module holding the weights of a list of parallel AnomalyAwareSelfAttention modules.
+        """
+        fused = cls(config, num_heads=len(attentions))
+        fused.load_state_dict(nn.ModuleList(attentions).state_dict())
+        return fused.to(attentions[0].query.weight.device)
+
+    def forward(self, hidden_states, attention_mask=None):
+        batch_size, seq_len, input_dim = hidden_states.size()
+
+        # Ensure that hidden_states matches the expected input dimension for this layer
+        if input_dim != self.hidden_size:
+            raise ValueError(f"Expected hidden_states with last dimension {self.hidden_size}, but got {input_dim}.")
+
+        # Compute the norm (magnitude) of the input vectors and scale the hidden states by it
+        input_norm = torch.norm(hidden_states, dim=-1, keepdim=True)  # Shape: [batch_size, seq_len, 1]
+        scaled_hidden_states = hidden_states / (input_norm + 1e-9)  # Prevent division by zero
+
+        # Query and value projections for every head in one packed Linear
+        projections = F.linear(
+            scaled_hidden_states,
+            self.projection_weight.view(-1, self.hidden_size),
+            self.projection_bias.view(-1)
+        )  # Shape: [batch_size, seq_len, 2 * num_heads * hidden_size]
+        projections = projections.view(batch_size * seq_len, 2, self.num_heads, self.hidden_size).permute(1, 2, 0, 3)
+        query_layer, value_layer = projections[0], projections[1]  # Shape: [num_heads, batch_size * seq_len, hidden_size]
+
+        # Anomaly transformation: one large matmul per head over every token of the batch
+        transformed_query = torch.bmm(query_layer, self.anomaly_matrix)
+
+        # Per-sample attention over [num_heads, batch_size, seq_len, hidden_size]
+        head_shape = (self.num_heads, batch_size, seq_len, self.hidden_size)
+        query_layer, value_layer, transformed_query = (
+            query_layer.reshape(head_shape), value_layer.reshape(head_shape), transformed_query.view(head_shape)
+        )
+
+        if self.attention_mode == 'nystrom' and self.num_landmarks < seq_len:
+            # Fold the heads into the batch so every head samples its landmarks like the per-module version
+            flat_shape = (self.num_heads * batch_size, seq_len, self.hidden_size)
+            context_layer = nystrom_attention(
+                query_layer.reshape(flat_shape), transformed_query.reshape(flat_shape), value_layer.reshape(flat_shape),
+                None if attention_mask is None else attention_mask.repeat(self.num_heads, 1),
+                self.num_landmarks, self.landmark_sampler, self.landmark_pinv_rtol, self.dropout
+            ).view(head_shape)
+        elif self.use_sdpa:
+            context_layer = F.scaled_dot_product_attention(
+                query_layer, transformed_query, value_layer,
+                attn_mask=None if attention_mask is None else attention_mask[None, :, None, :],
+                dropout_p=self.attention_probs_dropout_prob if self.training else 0.0
+            )
+        else:
+            # Compute magnitude-sensitive attention scores
+            if attention_mask is not None:
+                attention_mask = attention_mask[None, :, None, :]  # Shape [1, batch_size, 1, seq_len]
+            anomaly_scores = torch.matmul(query_layer, transformed_query.transpose(-1, -2)) / math.sqrt(self.hidden_size)
+            if attention_mask is not None:
+                anomaly_scores = anomaly_scores + attention_mask
+            attention_probs = self.dropout(F.softmax(anomaly_scores, dim=-1))
+            context_layer = torch.matmul(attention_probs, value_layer)  # Shape: [num_heads, batch_size, seq_len, hidden_size]
+
+        # Rescale context by input magnitude and concatenate the heads
+        context_layer = context_layer * input_norm
+        return context_layer.permute(1, 2, 0, 3).reshape(batch_size, seq_len, self.num_heads * self.hidden_size)
+
+class FusedStackedSelfAttention(nn.Module):
+    """
+    StackedSelfAttention with each layer's parallel modules fused into one MultiHeadAnomalyAwareSelfAttention.
+    Loads StackedSelfAttention state dicts unchanged ("layers.{layer}.{head}.query.weight", ...).
+    """
+    def __init__(self, attention_layers):
+        super(FusedStackedSelfAttention, self).__init__()
+        self.layers = nn.ModuleList(attention_layers)
+
+    @classmethod
+    def from_stacked(cls, stacked, config):
+        """
+        Fuse every layer of an existing StackedSelfAttention, keeping its weights.
+        """
+        layers = []
+        for layer in stacked.layers:
+            source = layer[0]
+            sampler = next(name for name, fn in LANDMARK_SAMPLERS.items() if fn is source.landmark_sampler)
+            layer_config = dict(config, hidden_size=source.hidden_size,
+                                attention_probs_dropout_prob=source.attention_probs_dropout_prob,
+                                attention_mode=source.attention_mode, num_landmarks=source.num_landmarks,
+                                landmark_sampler=sampler, landmark_pinv_rtol=source.landmark_pinv_rtol)
+            layers.append(MultiHeadAnomalyAwareSelfAttention.from_attention_modules(list(layer), layer_config))
+        return cls(layers)
+
+    def forward(self, hidden_states, attention_mask=None):
+        for layer in self.layers:
+            hidden_states = layer(hidden_states, attention_mask)
+        return hidden_states
+
 class DetectionModelLSTM(nn.Module):
-    def __init__(self, config):
+    def __init__(self, config, window_rows=None):
         super(DetectionModelLSTM, self).__init__()
 
+        # Compact vocabulary: inputs are TokenVocabulary ids (window rows from config['vocabulary_file'] if not given)
+        if window_rows is None and config.get('compact_vocabulary', False):
+            window_rows = TokenVocabulary.load(config['vocabulary_file']).window_rows
+
         # Embedding layer
         self.embedding = GraphAvgColAmplifiedEmbedding(
             vocab_size=config['vocab_size'],
@@ -856,7 +2053,9 @@ class DetectionModelLSTM(nn.Module):
             amplify_embedding_dim=config['amplify_embedding_dim'],
             num_graph_layers=config.get('num_graph_layers', 3),
             dropout_prob=config.get('dropout', 0.3),
-            k=config.get('nearest_neighbour', 7)
+            k=config.get('nearest_neighbour', 7),
+            window_rows=window_rows,
+            sparse=config.get('sparse_embedding', False)
         )
         self.embedding_activation = nn.GELU()  # Activation applied after embeddings
 
@@ -882,24 +2081,63 @@ class DetectionModelLSTM(nn.Module):
         self.fc_activation = nn.GELU()  # Activation after hidden layer
         self.fc_output = nn.Linear(config['hidden_size'], len(LABEL_MAPPING))  # Output layer for classification
 
-    def forward(self, discrete_indices, attention_mask=None):
+    def embed(self, discrete_indices):
         # Pass input through embedding layer
         combined_embeddings = self.embedding(discrete_indices)
-        combined_embeddings = self.embedding_activation(combined_embeddings)
+        return self.embedding_activation(combined_embeddings)
 
+    def encode(self, combined_embeddings):
         # Pass embeddings through LSTM
         lstm_output, _ = self.lstm(combined_embeddings)
 
         # Use the output from the last time step
-        output = lstm_output[:, -1, :]
+        return lstm_output[:, -1, :]
 
+    def classify(self, output):
         # Pass through fully connected layers
         output = self.fc_hidden(output)
         output = self.fc_activation(output)
-        output = self.fc_output(output)
+        return self.fc_output(output)
+
+    def forward(self, discrete_indices, attention_mask=None):
+        if profiler.enabled:
+            return self.profiled_forward(discrete_indices)
+        return self.classify(self.encode(self.embed(discrete_indices)))
+
+    def profiled_forward(self, discrete_indices):
+        """forward with torch.profiler ranges and profiler laps around each stage."""
+        output = discrete_indices
+        for name, stage in (("embedding", self.embed), ("lstm", self.encode), ("classifier", self.classify)):
+            with record_function(name):
+                output = stage(output)
+            profiler.lap(name)
         return output
 # Optuna Objective Function
 num_classes = len(LABEL_MAPPING) 
+fidelity_loaders = None  # (rung train loaders, validation loader), built on first use in each process
+
+def get_fidelity_loaders():
+    """
+    Loaders for multi-fidelity trials: one loader per rung over the next slice of a stratified
+    order of the training set (so rungs are nested and cumulative), and a fixed stratified validation subset.
+    """
+    global fidelity_loaders
+    if fidelity_loaders is None:
+        train_dataset, test_dataset = train_loader.dataset, test_loader.dataset
+        train_dataset.open()
+        test_dataset.open()
+        seed = config.get('fidelity_seed', 40)
+        train_order = stratified_order(train_dataset.labels, seed)
+        bounds = [0] + [max(1, int(round(fraction * len(train_order)))) for fraction in config['fidelity_fractions']]
+        rung_loaders = [
+            build_loader(Subset(train_dataset, train_order[start:stop]), shuffle=True)
+            for start, stop in zip(bounds[:-1], bounds[1:])
+        ]
+        test_order = stratified_order(test_dataset.labels, seed)
+        validation_size = max(1, int(round(config.get('validation_fraction', 0.25) * len(test_order))))
+        validation_loader = build_loader(Subset(test_dataset, np.sort(test_order[:validation_size])), shuffle=False)
+        fidelity_loaders = (rung_loaders, validation_loader)
+    return fidelity_loaders
 
 def objective(trial): 
     """
@@ -911,60 +2149,418 @@ def objective(trial):
     learning_rate = trial.suggest_float('lr', baselr, mxlr, log=True)
 
     # Initialize model, optimizer, and scheduler
-    model = DetectionModelLSTM(config).to(device)
-    optimizer = torch.optim.AdamW(model.parameters(), lr=learning_rate, weight_decay=1e-5)
+    model = prepare_model(DetectionModelLSTM(config))
+    optimizer = build_optimizer(model, learning_rate)
     criterion = nn.CrossEntropyLoss()
+    grad_scaler = build_grad_scaler()
     Trialscheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, mode='min', factor=0.1, patience=3, min_lr=1e-5)
 
+    def report_progress(step, running_loss):
+        # Sub-epoch report so the pruner can stop a bad learning rate after a few hundred batches
+        trial.report(running_loss, step)
+        if trial.should_prune():
+            raise optuna.exceptions.TrialPruned()
+
+    if config.get('search_fidelity', False):
+        # Multi-fidelity: keep training the same model on each further stratified slice and
+        # score it on the fixed validation subset; only trials that survive a rung see more data
+        rung_loaders, validation_loader = get_fidelity_loaders()
+        for rung, loader in enumerate(rung_loaders):
+            train_epoch(model, loader, optimizer, criterion, rung, grad_scaler=grad_scaler)
+            test_loss, _, _ = evaluate(model, validation_loader, criterion, num_classes)
+            Trialscheduler.step(test_loss)
+            trial.report(test_loss, rung + 1)
+            if trial.should_prune():
+                raise optuna.exceptions.TrialPruned()
+        return test_loss
+
     for epoch in range(1):  # Optuna trial duration
         # Training step
-        train_loss, _ = train_epoch(model, train_loader, optimizer, criterion, epoch)
+        train_loss, _ = train_epoch(
+            model, train_loader, optimizer, criterion, epoch, grad_scaler=grad_scaler, step_callback=report_progress
+        )
 
         # Evaluation step
-        test_loss, _, _, _, _, _ = evaluate(model, test_loader, criterion, num_classes)
+        test_loss, _, _ = evaluate(model, test_loader, criterion, num_classes)
 
         # Update the `Trialscheduler` with the validation loss
         Trialscheduler.step(test_loss)
 
-        # Report the test loss to Optuna
-        trial.report(test_loss, epoch)
+    return test_loss  # Minimize validation loss
 
-        # Prune the trial if it's not promising
-        if trial.should_prune():
-            raise optuna.exceptions.TrialPruned()
+def build_study_storage(storage):
+    """
+    Optuna storage shared by all search processes: an RDB URL is used as is, anything else is a journal file.
+    """
+    if "://" in storage:
+        # Heartbeats let optuna fail (and retry once) trials whose worker died
+        heartbeat = config.get('study_heartbeat', 60)
+        return optuna.storages.RDBStorage(
+            storage, heartbeat_interval=heartbeat, grace_period=2 * heartbeat,
+            failed_trial_callback=optuna.storages.RetryFailedTrialCallback(max_retry=1),
+        )
+    try:
+        from optuna.storages.journal import JournalFileBackend
+    except ImportError:  # optuna < 4.0
+        from optuna.storages import JournalFileStorage as JournalFileBackend
+    return optuna.storages.JournalStorage(JournalFileBackend(storage))
 
-    return test_loss  # Minimize validation loss
+def build_pruner():
+    """
+    Pruner over the sub-epoch reports of `objective`; resources are counted in training steps.
+    """
+    name = config.get('pruner', 'hyperband')
+    min_resource = config.get('report_interval', 100)
+    max_resource = len(train_loader)
+    if config.get('search_fidelity', False):
+        # Multi-fidelity trials report once per rung instead of every `report_interval` steps
+        min_resource, max_resource = 1, len(config['fidelity_fractions'])
+    if name == 'hyperband':
+        return optuna.pruners.HyperbandPruner(min_resource=min_resource, max_resource=max_resource, reduction_factor=3)
+    if name == 'successive_halving':
+        return optuna.pruners.SuccessiveHalvingPruner(min_resource=min_resource, reduction_factor=3)
+    return optuna.pruners.NopPruner()
+
+# Config values that change what a search trial measures; the data is identified by the token files
+SEARCH_CONFIG_KEYS = (
+    'baselr', 'mxlr', 'batch_size', 'num_epochs', 'value_embedding_dim', 'position_embedding_dim', 'vocab_size',
+    'lower_bound', 'upper_bound', 'hidden_size', 'num_layers', 'dropout', 'num_attention_heads',
+    'attention_probs_dropout_prob', 'kernel_size', 'amplify_embedding_dim', 'num_graph_layers', 'nearest_neighbour',
+    'amp', 'amp_dtype', 'attention_mode', 'num_landmarks', 'landmark_sampler', 'compact_vocabulary',
+    'sparse_embedding', 'weighted_unique', 'pruner', 'report_interval', 'search_fidelity', 'fidelity_fractions',
+    'validation_fraction', 'fidelity_seed',
+)
+
+def search_key(train_paths, test_paths):
+    """
+    Key of a learning-rate search: hashes of the token/label files and the search-related config.
+    A stored study is only resumed by a run with the same key.
+    """
+    fields = {
+        'data': [file_digest(path) for path in (*train_paths, *test_paths)],
+        'config': {name: config.get(name) for name in SEARCH_CONFIG_KEYS},
+    }
+    return hashlib.sha256(json.dumps(fields, sort_keys=True).encode()).hexdigest()[:16]
+
+def study_name():
+    key = config.get('search_key')
+    return f"{config['study_name']}-{key}" if key else config['study_name']
+
+def load_study(seed=None):
+    return optuna.create_study(
+        study_name=study_name(),
+        storage=build_study_storage(config['study_storage']),
+        direction="minimize",
+        sampler=optuna.samplers.TPESampler(seed=seed),
+        pruner=build_pruner(),
+        load_if_exists=True,
+    )
+
+def init_search_worker(worker_config, train_paths, test_paths):
+    """
+    Process-pool initializer: every worker reopens the same memory-mapped token files,
+    so the arrays are shared through the page cache instead of being copied per process.
+    """
+    global train_loader, test_loader
+    config.update(worker_config)
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // config['search_workers']))
+    train_loader = build_loader(TokenDataset(*train_paths), shuffle=True)
+    test_loader = build_loader(TokenDataset(*test_paths), shuffle=False)
+
+class SurplusTrial(Exception):
+    """A trial created after the study already had `n_trials` trials (workers asking at the same time)."""
+
+def started_states():
+    # A function, so importing bcudemo does not import optuna
+    return optuna.trial.TrialState.COMPLETE, optuna.trial.TrialState.PRUNED, optuna.trial.TrialState.RUNNING
+
+def capped_objective(trial):
+    """
+    objective, unless `n_trials` started trials were created before this one. Trial numbers are handed
+    out by the storage in order, so whichever worker asked last gives its trial up (it fails without
+    training) and stops; the started trials across all workers never exceed `n_trials`.
+    """
+    earlier = [t for t in trial.study.get_trials(deepcopy=False, states=started_states()) if t.number < trial.number]
+    if len(earlier) >= config['n_trials']:
+        trial.study.stop()
+        raise SurplusTrial(f"Trial {trial.number} is beyond n_trials={config['n_trials']}")
+    return objective(trial)
+
+def fail_stale_trials(study):
+    """
+    Fail trials an interrupted run left RUNNING and queue their learning rates again.
+    Journal storages have no heartbeat, so run_study calls this before its workers start; a journal
+    study must therefore not be searched by two runs at once.
+    """
+    for trial in study.get_trials(deepcopy=False, states=(optuna.trial.TrialState.RUNNING,)):
+        # Same calls optuna's own heartbeat-based fail_stale_trials makes
+        study._storage.set_trial_state_values(trial._trial_id, state=optuna.trial.TrialState.FAIL)
+        if trial.params:
+            study.enqueue_trial(trial.params)
+        print(f"Failed stale trial {trial.number} of an interrupted search; its parameters are queued again")
+
+def run_search_worker(seed=None):
+    """
+    Pull trials from the shared study until it holds `n_trials` started (finished or running) trials.
+    A study that already holds them runs no further trial.
+    """
+    study = load_study(seed)
+    if len(study.get_trials(deepcopy=False, states=started_states())) >= config['n_trials']:
+        return
+    # Stop asking once the started trials (including other workers' running ones) reach n_trials
+    stop = optuna.study.MaxTrialsCallback(config['n_trials'], states=started_states())
+    study.optimize(capped_objective, n_trials=config['n_trials'], callbacks=[stop], catch=(SurplusTrial,))
+
+def select_learning_rates(study, top_k=4):
+    """
+    Learning rates of all completed trials and of the `top_k` completed trials with the lowest loss.
+    Pruned and failed trials never count: their values are partial. With fewer than `top_k` completed
+    trials the ones there are are used, and with none config['fallback_lrs'].
+    """
+    completed = study.get_trials(deepcopy=False, states=(optuna.trial.TrialState.COMPLETE,))
+    good_lrs = [trial.params['lr'] for trial in completed]
+
+    # Sort by test loss and select the top k
+    sorted_trials = sorted(completed, key=lambda t: t.value)
+    top_lrs = [trial.params['lr'] for trial in sorted_trials[:top_k]]
+    if not top_lrs:
+        print(f"Warning: no search trial completed, using the fallback learning rates {config['fallback_lrs']}")
+        top_lrs = list(config['fallback_lrs'])
+    elif len(top_lrs) < top_k:
+        print(f"Warning: only {len(top_lrs)} of {top_k} learning rates come from completed trials")
+    return good_lrs, top_lrs
+
+def run_study(train_paths, test_paths):
+    """
+    Run the learning-rate search, in this process or across `search_workers` processes, and return the study.
+    The study is named after search_key, so a changed dataset or search config starts a fresh study.
+    """
+    config['search_key'] = search_key(train_paths, test_paths)
+    print(f"Learning-rate study: {study_name()}")
+    if "://" not in config['study_storage']:
+        fail_stale_trials(load_study())
+    workers = config.get('search_workers', 1)
+    if workers <= 1:
+        run_search_worker()
+        return load_study()
+
+    # spawn keeps CUDA usable in the workers; each worker runs its share of trials against the shared storage
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_search_worker,
+        initargs=(dict(config), train_paths, test_paths),
+    ) as pool:
+        for future in [pool.submit(run_search_worker) for _ in range(workers)]:
+            future.result()
+    return load_study()
 
 # Training loop
+def amp_dtype():
+    return getattr(torch, config.get('amp_dtype', 'bfloat16'))
 
-def train_epoch(model, loader, optimizer, criterion, epoch, scheduler=None):
-    model.train()
-    total_loss, correct, total = 0, 0, 0
-    progress_bar = tqdm(loader, desc=f"Epoch {epoch + 1}", leave=False)
+def autocast_context():
+    """
+    Autocast region for the configured AMP mode; a no-op when config['amp'] is off.
+    """
+    return autocast(device_type=device.type, dtype=amp_dtype(), enabled=config.get('amp', False))
+
+def build_grad_scaler():
+    """
+    Loss scaler for float16 AMP. bfloat16 keeps fp32's exponent range, so the scaler stays disabled.
+    """
+    return GradScaler(device.type, enabled=config.get('amp', False) and amp_dtype() == torch.float16)
 
-    for batch_X, batch_y in progress_bar:
-        batch_X, batch_y = batch_X.to(device), batch_y.to(device)
+def prepare_model(model):
+    """
+    Move the model to `device` and optionally wrap it with torch.compile.
+    """
+    model = model.to(device)
+    if config.get('compile_model', False):
+        model = torch.compile(model)
+    return model
+
+class SplitOptimizer(torch.optim.Optimizer):
+    """
+    SparseAdam for parameters with sparse gradients and AdamW for the rest, behind one Optimizer.
+
+    The inner optimizers' param_groups are the outer ones, so LR schedulers, GradScaler and
+    checkpoints keep treating it as a single optimizer. SparseAdam only updates the rows a batch
+    touched and applies no weight decay. It still keeps dense exp_avg/exp_avg_sq buffers for the
+    whole table, so optimizer state takes as much memory as with AdamW; only the gradient is
+    smaller, and any step-time gain depends on how few rows a batch touches.
+    """
+    def __init__(self, sparse_params, dense_params, lr, weight_decay=1e-5):
+        self.sparse = torch.optim.SparseAdam(sparse_params, lr=lr)
+        self.dense = torch.optim.AdamW(dense_params, lr=lr, weight_decay=weight_decay)
+        self.optimizers = (self.sparse, self.dense)
+        super(SplitOptimizer, self).__init__(self.sparse.param_groups + self.dense.param_groups, {'lr': lr})
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+        for optimizer in self.optimizers:
+            optimizer.step()
+        return loss
+
+    def zero_grad(self, set_to_none=True):
+        for optimizer in self.optimizers:
+            optimizer.zero_grad(set_to_none=set_to_none)
+
+    def state_dict(self):
+        return {'sparse': self.sparse.state_dict(), 'dense': self.dense.state_dict()}
+
+    def load_state_dict(self, state_dict):
+        self.sparse.load_state_dict(state_dict['sparse'])
+        self.dense.load_state_dict(state_dict['dense'])
+        # Loading replaces the inner group dicts; share them again
+        self.param_groups = self.sparse.param_groups + self.dense.param_groups
+
+def build_optimizer(model, lr):
+    """
+    AdamW over the whole model, or with 'sparse_embedding' a SplitOptimizer: SparseAdam for the
+    sparse value embedding, AdamW for everything else.
+    """
+    if not config.get('sparse_embedding', False):
+        return torch.optim.AdamW(model.parameters(), lr=lr, weight_decay=1e-5)
+    sparse_params = [
+        module.weight for module in model.modules() if isinstance(module, nn.Embedding) and module.sparse
+    ]
+    sparse_ids = {id(p) for p in sparse_params}
+    dense_params = [p for p in model.parameters() if id(p) not in sparse_ids]
+    return SplitOptimizer(sparse_params, dense_params, lr=lr, weight_decay=1e-5)
+
+def batch_loss(criterion, logits, targets, counts=None):
+    """
+    criterion(logits, targets), or with duplicate `counts` (weighted-unique data) the count-weighted
+    mean, i.e. the loss of the batch with every row repeated `count` times.
+    """
+    if counts is None:
+        return criterion(logits, targets)
+    losses = F.cross_entropy(
+        logits, targets, weight=criterion.weight, reduction='none', label_smoothing=criterion.label_smoothing
+    )
+    return (losses * counts).sum() / counts.sum()
+
+def train_epoch(model, loader, optimizer, criterion, epoch, scheduler=None, grad_scaler=None, step_callback=None,
+                start_step=0, checkpoint_callback=None):
+    """
+    Train for one epoch. `step_callback(step, running_loss)` is called every `report_interval` steps and
+    `checkpoint_callback(step)` every `checkpoint_interval` steps. When resuming, `start_step` is the number
+    of batches the loader's sampler was told to skip; metrics then cover the remaining batches only.
+    """
+    model.train()
+    if grad_scaler is None:
+        grad_scaler = build_grad_scaler()
+    log_interval = config.get('log_interval', 50)
+    report_interval = config.get('report_interval', 100)
+    checkpoint_interval = config.get('checkpoint_interval', 500)
+    # Metrics stay on the device and are only synced every `log_interval` steps and at epoch end
+    total_loss = torch.zeros((), device=device)
+    correct = torch.zeros((), dtype=torch.long, device=device)
+    total = 0
+    progress_bar = tqdm(loader, desc=f"Epoch {epoch + 1}", leave=False, initial=start_step, total=len(loader))
+    profiler.begin_epoch()
+
+    for step, batch in enumerate(progress_bar, start=start_step + 1):
+        batch_X, batch_y = batch[0].to(device, non_blocking=True), batch[1].to(device, non_blocking=True)
+        batch_counts = batch[2] if len(batch) > 2 else None  # Weighted-unique data: duplicates per row
+        counts = batch_counts.to(device, non_blocking=True) if batch_counts is not None else None
 
         # Forward pass
+        profiler.lap('data')
         optimizer.zero_grad()
-        logits = model(batch_X)
-        loss = criterion(logits, batch_y)
+        with autocast_context():
+            logits = model(batch_X)
+            loss = batch_loss(criterion, logits, batch_y, counts)
+        profiler.lap('loss')
+
+        # Backward pass and optimization (the scaler is a pass-through unless float16 AMP is on)
+        with profiler.region("backward"):
+            grad_scaler.scale(loss).backward()
+        profiler.lap('backward')
+        with profiler.region("optimizer_step"):
+            grad_scaler.step(optimizer)
+            grad_scaler.update()
+
+            # Step the scheduler if provided
+            if scheduler is not None:
+                scheduler.step()
+        profiler.lap('optimizer')
 
-        # Backward pass and optimization
-        loss.backward()
-        optimizer.step()
+        # Track metrics
+        total_loss += loss.detach()
+        if counts is None:
+            correct += (torch.argmax(logits, dim=1) == batch_y).sum()
+            total += batch_y.size(0)
+        else:
+            correct += ((torch.argmax(logits, dim=1) == batch_y) * counts).sum()
+            total += int(batch_counts.sum())  # Summed before the device copy, so no sync
+        if step % log_interval == 0:
+            progress_bar.set_postfix(loss=loss.item(), accuracy=100 * correct.item() / total)
+        if step_callback is not None and step % report_interval == 0:
+            step_callback(step, total_loss.item() / (step - start_step))
+        if checkpoint_callback is not None and checkpoint_interval and step % checkpoint_interval == 0:
+            checkpoint_callback(step)
+        profiler.lap('bookkeeping')
+        profiler.step()
+
+    steps = len(loader) - start_step
+    train_loss, train_accuracy = total_loss.item() / max(steps, 1), 100 * correct.item() / max(total, 1)
+    profiler.end_epoch(epoch, total, steps=steps, loss=train_loss, accuracy=train_accuracy)
+    return train_loss, train_accuracy
+
+class ClassificationMetrics:
+    """
+    Confusion matrix accumulated on the device, one bincount per batch.
 
-        # Step the scheduler if provided
-        if scheduler is not None:
-            scheduler.step()
+    Rows are true labels and columns predictions (sklearn's layout). Accuracy, per-class accuracy
+    (recall), precision and F1 are all derived from the matrix, so the cost of a pass does not
+    depend on how many predictions were made and nothing is copied to the host until asked.
+    """
+    def __init__(self, num_classes, device=device):
+        self.num_classes = num_classes
+        self.counts = torch.zeros(num_classes * num_classes, dtype=torch.long, device=device)
+
+    def reset(self):
+        self.counts.zero_()
+
+    def update(self, predictions, targets, weights=None):
+        """Add a batch; `weights` (e.g. duplicate counts) counts each row that many times."""
+        index = targets * self.num_classes + predictions
+        if weights is None:
+            self.counts += torch.bincount(index, minlength=self.counts.numel())
+        else:
+            self.counts.index_add_(0, index, weights)
 
-        # Track metrics
-        total_loss += loss.item()
-        correct += (torch.argmax(logits, dim=1) == batch_y).sum().item()
-        total += batch_y.size(0)
-        progress_bar.set_postfix(loss=loss.item(), accuracy=100 * correct / total)
+    def confusion_matrix(self):
+        return self.counts.view(self.num_classes, self.num_classes).cpu().numpy()
 
-    return total_loss / len(loader), 100 * correct / total
+    def summary(self, cm=None):
+        """
+        Accuracy and per-class accuracy/precision/recall/F1 from one host copy of the matrix.
+        A class that has true rows but is never predicted scores precision 0 and F1 0; ratios are NaN
+        only for classes absent from both targets and predictions (recall: absent from the targets),
+        so nanmean skips just those in the macro F1.
+        """
+        cm = self.confusion_matrix() if cm is None else cm
+        true_positives = cm.diagonal().astype(np.float64)
+        support, predicted = cm.sum(axis=1), cm.sum(axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            recall = true_positives / support
+            precision = np.where(predicted > 0, true_positives / predicted, np.where(support > 0, 0.0, np.nan))
+            f1 = 2 * true_positives / (support + predicted)  # 2tp / (2tp + fp + fn)
+        return {
+            'accuracy': true_positives.sum() / max(cm.sum(), 1),
+            'label_accuracy': recall,  # Per-class accuracy is the recall of that class
+            'precision': precision,
+            'recall': recall,
+            'f1': f1,
+            'macro_f1': np.nanmean(f1) if np.isfinite(f1).any() else float('nan'),
+        }
 
 # Evaluation function
 def evaluate(model, loader, criterion, num_classes):
@@ -972,46 +2568,42 @@ def evaluate(model, loader, criterion, num_classes):
     Evaluate the model on the given data loader and compute:
     - Total loss
     - Overall accuracy
-    - Per-label accuracy
-    - Confusion matrix
+    - ClassificationMetrics (confusion matrix, per-label accuracy, precision, recall, F1)
     """
     model.eval()
-    total_loss, correct, total = 0, 0, 0
-    all_preds, all_targets = [], []
+    total_loss = torch.zeros((), device=device)
+    metrics = ClassificationMetrics(num_classes)
+    rows_seen = 0
 
-    with torch.no_grad():
-        for batch_X, batch_y in loader:
-            batch_X, batch_y = batch_X.to(device), batch_y.to(device)
+    with torch.no_grad(), profiler.stage('evaluate') as record:
+        for batch in loader:
+            batch_X, batch_y = batch[0].to(device, non_blocking=True), batch[1].to(device, non_blocking=True)
+            counts = batch[2].to(device, non_blocking=True) if len(batch) > 2 else None
 
             # Forward pass
-            logits = model(batch_X)
-
-            # Compute loss
-            loss = criterion(logits, batch_y)
-            total_loss += loss.item()
-
-            # Predictions
-            preds = torch.argmax(logits, dim=1)
-
-            # Compute batch-level accuracy
-            correct += (preds == batch_y).sum().item()
-            total += batch_y.size(0)
+            with autocast_context():
+                logits = model(batch_X)
 
-            # Collect predictions and targets for label-level accuracy
-            all_preds.extend(preds.cpu().numpy())
-            all_targets.extend(batch_y.cpu().numpy())
+                # Compute loss
+                loss = batch_loss(criterion, logits, batch_y, counts)
+            # Accumulate the loss summed over the represented rows (with counts, every row stands for its duplicates)
+            total_loss += loss * (batch_y.size(0) if counts is None else counts.sum())
 
-    # Compute label-wise accuracy and confusion matrix
-    label_accuracy, cm = compute_label_accuracy(all_targets, all_preds, num_classes)
+            # Confusion matrix updated on the device; with counts every row stands for its duplicates,
+            # so the metrics match the expanded split
+            metrics.update(torch.argmax(logits, dim=1), batch_y, counts)
+            rows_seen += batch_y.size(0)
+        record['samples'] = rows_seen
 
     # Verify consistency of predictions and targets
-    assert len(all_preds) == len(all_targets), "Mismatch between predictions and targets!"
+    assert rows_seen == len(loader.dataset), "Mismatch between predictions and dataset size!"
+    num_samples = int(metrics.counts.sum())
 
-    # Overall loss and accuracy
-    avg_loss = total_loss / len(loader)
-    overall_accuracy = 100 * correct / total
+    # Overall loss (per sample, so the last short batch is not over-weighted) and accuracy
+    avg_loss = total_loss.item() / num_samples
+    overall_accuracy = 100 * metrics.summary()['accuracy']
 
-    return avg_loss, overall_accuracy, all_preds, all_targets, label_accuracy, cm
+    return avg_loss, overall_accuracy, metrics
 
 # Custom Learning Rate Scheduler
 class CustomLRScheduler:
@@ -1043,13 +2635,90 @@ class CustomLRScheduler:
             param_group['lr'] = lr
         print(f"Epoch {epoch}: Learning Rate set to {lr}")
 
+    def state_dict(self):
+        return {'lr_list': list(self.lr_list), 'switch_epochs': list(self.switch_epochs)}
+
+    def load_state_dict(self, state_dict):
+        self.lr_list = state_dict['lr_list']
+        self.switch_epochs = state_dict['switch_epochs']
+
+# Checkpointing
+def snapshot_state(state):
+    """
+    Recursively copy every tensor in `state` to the CPU, so the copy can be written while training moves on.
+    """
+    if torch.is_tensor(state):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {key: snapshot_state(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot_state(value) for value in state)
+    return state
+
+def rng_state():
+    state = {'torch': torch.get_rng_state(), 'numpy': np.random.get_state(), 'python': random.getstate()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['python'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+def unwrap_model(model):
+    """The module whose state_dict is saved: torch.compile wrappers keep it in `_orig_mod`."""
+    return getattr(model, '_orig_mod', model)
+
+class CheckpointWriter:
+    """
+    Write checkpoints on a background thread.
+
+    `save` snapshots the state to CPU and returns; the thread writes it to a temporary file and renames
+    it over the target, so an interrupted write never leaves a truncated checkpoint behind.
+    """
+    def __init__(self, max_pending=2):
+        self.pending = queue.Queue(maxsize=max_pending)  # save() blocks once the writer is this far behind
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            state, path = item
+            try:
+                temporary_path = path + ".tmp"
+                torch.save(state, temporary_path)
+                os.replace(temporary_path, path)
+            except Exception as e:
+                self.error = e
+
+    def check(self):
+        if self.error is not None:
+            raise RuntimeError("Writing a checkpoint failed") from self.error
+
+    def save(self, state, path):
+        self.check()
+        self.pending.put((snapshot_state(state), path))
+
+    def close(self):
+        self.pending.put(None)
+        self.thread.join()
+        self.check()
+
 # Final Training Function
-def final_training():
+def final_training(resume=None):
     """
     Train the model with the best learning rates loaded from lrrate.json and generate evaluation plots.
+    Checkpoints go to config['checkpoint_dir']; `resume` is a checkpoint path to continue from at its exact batch.
     """
     # Load learning rates from JSON file
-    output_dir = "training_outputs"
+    output_dir = config.get('output_dir', "training_outputs")
     os.makedirs(output_dir, exist_ok=True)
     try:
         with open("lrrate.json", "r") as f:
@@ -1068,9 +2737,10 @@ def final_training():
     switch_epochs = [config['num_epochs'] // len(lr_list) * i for i in range(1, len(lr_list))]
 
     # Initialize model, optimizer, and scheduler for final training
-    model = DetectionModelLSTM(config).to(device)
-    optimizer = torch.optim.AdamW(model.parameters(), lr=lr_list[0], weight_decay=1e-5)
+    model = prepare_model(DetectionModelLSTM(config))
+    optimizer = build_optimizer(model, lr_list[0])
     criterion = nn.CrossEntropyLoss()
+    grad_scaler = build_grad_scaler()
 
     # CyclicLR for intra-epoch dynamics
     scheduler = torch.optim.lr_scheduler.CyclicLR(
@@ -1085,66 +2755,161 @@ def final_training():
     # Custom scheduler for epoch-level adjustments
     custom_scheduler = CustomLRScheduler(optimizer, lr_list=lr_list, switch_epochs=switch_epochs)
     
-    # Directory to save plots and outputs
-    output_dir = "training_outputs"
-    os.makedirs(output_dir, exist_ok=True)
+    # Checkpoints: last.pt is rewritten periodically, best.pt whenever the test loss improves
+    checkpoint_dir = config.get('checkpoint_dir', 'checkpoints')
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    last_path = os.path.join(checkpoint_dir, "last.pt")
+    best_path = os.path.join(checkpoint_dir, "best.pt")
+    writer = CheckpointWriter()
+
+    # Plots are rendered by a worker so the next epoch can start right away
+    plot_worker = PlotWorker(config.get('plot_mode', 'thread'))
+    plot_every = config.get('plot_every', 1)
+    sampler = loader_sampler(train_loader)
 
     # Training loop
     train_accuracies, test_accuracies = [], []
-    for epoch in range(config['num_epochs']):
-        # Update learning rate using CustomLRScheduler
-        custom_scheduler.step(epoch)
-
-        # Training step
+    start_epoch, start_step, best_test_loss = 0, 0, float('inf')
+
+    if resume is not None:
+        checkpoint = torch.load(resume, map_location='cpu', weights_only=False)
+        unwrap_model(model).load_state_dict(checkpoint['model'])
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        scheduler.load_state_dict(checkpoint['scheduler'])
+        custom_scheduler.load_state_dict(checkpoint['custom_scheduler'])
+        grad_scaler.load_state_dict(checkpoint['grad_scaler'])
+        set_rng_state(checkpoint['rng'])
+        sampler.seed = checkpoint['sampler_seed']
+        start_epoch, start_step = checkpoint['epoch'], checkpoint['step']
+        train_accuracies, test_accuracies = checkpoint['train_accuracies'], checkpoint['test_accuracies']
+        best_test_loss = checkpoint['best_test_loss']
+        print(f"Resumed from {resume} at epoch {start_epoch + 1}, batch {start_step}")
+
+    def training_state(epoch, step):
+        # `epoch`/`step` point at the next batch to train on
+        return {
+            'model': unwrap_model(model).state_dict(),
+            'optimizer': optimizer.state_dict(),
+            'scheduler': scheduler.state_dict(),
+            'custom_scheduler': custom_scheduler.state_dict(),
+            'grad_scaler': grad_scaler.state_dict(),
+            'rng': rng_state(),
+            'sampler_seed': sampler.seed,
+            'epoch': epoch,
+            'step': step,
+            'train_accuracies': list(train_accuracies),
+            'test_accuracies': list(test_accuracies),
+            'best_test_loss': best_test_loss,
+            'config': dict(config),
+        }
+
+    for epoch in range(start_epoch, config['num_epochs']):
+        skip = start_step if epoch == start_epoch else 0
+        # Update learning rate using CustomLRScheduler (a mid-epoch resume already restored the optimizer's lr)
+        if skip == 0:
+            custom_scheduler.step(epoch)
+
+        # Training step, replaying this epoch's batch order from the first batch not yet trained on
+        sampler.set_epoch(epoch, skip)
         train_loss, train_accuracy = train_epoch(
-            model, train_loader, optimizer, criterion, epoch, scheduler
+            model, train_loader, optimizer, criterion, epoch, scheduler, grad_scaler, start_step=skip,
+            checkpoint_callback=lambda step: writer.save(training_state(epoch, step), last_path)
         )
 
         # Evaluation step
-        test_loss, test_accuracy, test_preds, test_targets, label_accuracy, cm = evaluate(
-            model, test_loader, criterion, num_classes
-        )
+        test_loss, test_accuracy, test_metrics = evaluate(model, test_loader, criterion, num_classes)
+        cm = test_metrics.confusion_matrix()
+        summary = test_metrics.summary(cm)
 
         # Log metrics
         print(f"Epoch {epoch + 1}:")
         print(f"  Train Loss = {train_loss:.4f}, Train Accuracy = {train_accuracy:.2f}%")
-        print(f"  Test Loss = {test_loss:.4f}, Test Accuracy = {test_accuracy:.2f}%")
+        print(f"  Test Loss = {test_loss:.4f}, Test Accuracy = {test_accuracy:.2f}%, Macro F1 = {summary['macro_f1']:.4f}")
 
         train_accuracies.append(train_accuracy)
         test_accuracies.append(test_accuracy)
-        # Plot and save confusion matrix
-        plot_confusion_matrix(test_targets, test_preds, epoch, output_dir)
 
-        # Plot and save accuracy graph
-        plot_accuracy(train_accuracies, test_accuracies, output_dir)
+        # End-of-epoch checkpoints
+        if test_loss < best_test_loss:
+            best_test_loss = test_loss
+            writer.save(training_state(epoch + 1, 0), best_path)
+        writer.save(training_state(epoch + 1, 0), last_path)
+
+        if epoch == config['num_epochs'] - 1 or (plot_every and (epoch + 1) % plot_every == 0):
+            # Time spent on the training thread: all of the plotting in 'sync' mode, only the hand-off otherwise
+            with profiler.stage('plot_submit', epoch=epoch):
+                # Plot and save confusion matrix
+                plot_worker.submit(plot_confusion_matrix, cm, epoch, output_dir)
 
-        # Plot and save per-label accuracy
-        plot_label_accuracy(label_accuracy, epoch, output_dir)
+                # Plot and save accuracy graph (copies, the lists keep growing while the worker draws)
+                plot_worker.submit(plot_accuracy, list(train_accuracies), list(test_accuracies), output_dir)
+
+                # Plot and save per-label accuracy
+                plot_worker.submit(plot_label_accuracy, summary['label_accuracy'], epoch, output_dir)
 
         # Update learning rate (only if not using CyclicLR as primary)
         # custom_scheduler.step(epoch)
+    writer.close()
+    with profiler.stage('plot_wait'):
+        plot_worker.close()  # Plots still queued on the worker when training ends
     print("Training Complete. Results and plots saved in:", output_dir)
     return train_accuracies, test_accuracies
-run_optimization = config.get('run_optimization', True) 
-save_results = config.get('save_lrs', True)
 
-if run_optimization:
-    # Run Optuna optimization
-    study = optuna.create_study(direction="minimize")
-    study.optimize(objective, n_trials=20)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train the anomaly-aware intrusion detection model.")
+    parser.add_argument(
+        "--resume", nargs="?", const=os.path.join(config['checkpoint_dir'], "last.pt"), default=None,
+        help="Continue final training from a checkpoint (default: the last periodic checkpoint)"
+    )
+    args = parser.parse_args()
+
+    # Load Dataset
+    input_csv = r"./estimate_1/subset_1.csv"
+    config['embedding_dim'] = config['value_embedding_dim'] + config['position_embedding_dim'] + config['amplify_embedding_dim']
+
+    if config.get('profile', False):
+        output_dir = config.get('output_dir', "training_outputs")
+        profiler = PipelineProfiler(
+            os.path.join(output_dir, config['profile_file']), enabled=True,
+            trace_steps=config.get('profile_trace_steps', 0), trace_skip=config.get('profile_trace_skip', 10),
+            trace_file=os.path.join(output_dir, config['profile_trace_file']),
+        )
+
+    # Scaled tokens come from the preprocessing cache when the CSV and preprocessing config are unchanged
+    with profiler.stage('prepare_datasets'):
+        train_paths, test_paths = prepare_datasets(input_csv, test_size=0.2, random_state=40)
+    X_train_loaded = np.load(train_paths[0], mmap_mode='r')
+    X_test_loaded = np.load(test_paths[0], mmap_mode='r')
+
+    print("Loaded X_train_scaled from disk. Shape:", X_train_loaded.shape)
+    print("Loaded X_test_scaled from disk. Shape:", X_test_loaded.shape)
+
+    # Zero-copy datasets over the memory-mapped token files
+    train_dataset = TokenDataset(*train_paths)
+    test_dataset = TokenDataset(*test_paths)
+
+    # Prepare DataLoader
+    train_loader = build_loader(train_dataset, shuffle=True)
+    test_loader = build_loader(test_dataset, shuffle=False)
+
+    run_optimization = config.get('run_optimization', True) and args.resume is None
+    save_results = config.get('save_lrs', True)
 
-    if save_results:
-        # Save the best 4 learning rates to a JSON file
-        good_lrs = [trial.params['lr'] for trial in study.trials if trial.state == optuna.trial.TrialState.COMPLETE]
+    if run_optimization:
+        # Run Optuna optimization (resumes the stored study if it was interrupted)
+        with profiler.stage('lr_search'):
+            study = run_study(train_paths, test_paths)
 
-        # Sort by test loss and select the top 4
-        sorted_trials = sorted(study.trials, key=lambda t: t.value if t.state == optuna.trial.TrialState.COMPLETE else float('inf'))
-        top_4_lrs = [trial.params['lr'] for trial in sorted_trials[:4]]
+        if save_results:
+            # Save the best 4 learning rates to a JSON file
+            good_lrs, top_4_lrs = select_learning_rates(study)
 
-        with open("lrrate.json", "w") as f:
-            json.dump({"good_lrs": good_lrs, "top_4_lrs": top_4_lrs}, f, indent=4)
+            with open("lrrate.json", "w") as f:
+                json.dump({"good_lrs": good_lrs, "top_4_lrs": top_4_lrs}, f, indent=4)
 
-        print(f"Top 4 learning rates: {top_4_lrs}")
+            print(f"Top 4 learning rates: {top_4_lrs}")
 
-# Final Training
-train_accuracies, test_accuracies = final_training()
+    # Final Training
+    with profiler.stage('final_training'):
+        train_accuracies, test_accuracies = final_training(resume=args.resume)
+    profiler.close()
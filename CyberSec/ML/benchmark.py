@@ -0,0 +1,805 @@
+"""
+Benchmarks for the bcudemo.py training pipeline on synthetic data.
+
+Run from this directory, for example:
+    python benchmark.py amp --rows 8192 --batch-size 256
+    python benchmark.py neighbour --batch-size 256
+    python benchmark.py graph --batch-sizes 64 256 1024
+    python benchmark.py attention --batch-size 64
+    python benchmark.py landmarks --seq-lens 46 512 2048 --landmarks 8 16 32
+    python benchmark.py search --rows 20000 --trials 12
+    python benchmark.py vocabulary --rows 100000 --cardinality 500
+    python benchmark.py sparse --batch-size 256 --cardinality 50
+    python benchmark.py dedup --rows 20000 --unique-rows 500
+    python benchmark.py weighted --rows 20000 --unique-rows 2000
+    python benchmark.py metrics --rows 1000000 --batch-size 4096
+    python benchmark.py suite --threads 1 --save-baseline baseline.json
+    python benchmark.py suite --threads 1 --compare baseline.json --tolerance 0.1
+"""
+import argparse
+import json
+import os
+import platform
+import tempfile
+import threading
+import time
+
+import numpy as np
+import psutil
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+import bcudemo
+from bcudemo import (
+    config, device, AnomalyAwareSelfAttention, DetectionModelLSTM, FusedStackedSelfAttention,
+    GraphAvgColAmplifiedEmbedding, StackedSelfAttention, TokenDataset, TokenVocabulary
+)
+
+NUM_FEATURES = 46
+
+class PeakMemory:
+    """
+    Track peak process RSS (sampled on a background thread) and peak CUDA memory over a block.
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.process = psutil.Process()
+        self.peak_rss = 0
+        self.peak_cuda = 0
+
+    def sample(self):
+        while not self.done.is_set():
+            self.peak_rss = max(self.peak_rss, self.process.memory_info().rss)
+            self.done.wait(self.interval)
+
+    def __enter__(self):
+        self.done = threading.Event()
+        self.peak_rss = self.process.memory_info().rss
+        if device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.done.set()
+        self.thread.join()
+        self.peak_rss = max(self.peak_rss, self.process.memory_info().rss)
+        if device.type == 'cuda':
+            self.peak_cuda = torch.cuda.max_memory_allocated()
+
+def make_token_dataset(rows, directory, seed=0, learnable=False):
+    """
+    Write `rows` synthetic token rows and labels to .npy files and wrap them in a TokenDataset.
+    With `learnable` the label is a bucket of the first token, so the loss actually depends on the learning rate.
+    """
+    rng = np.random.default_rng(seed)
+    num_labels = len(bcudemo.LABEL_MAPPING)
+    tokens = rng.integers(config['lower_bound'], config['upper_bound'], size=(rows, NUM_FEATURES), dtype=np.int32)
+    if learnable:
+        labels = ((tokens[:, 0] - config['lower_bound']) * num_labels // (config['upper_bound'] - config['lower_bound'])).astype(np.int8)
+    else:
+        labels = rng.integers(0, num_labels, size=rows, dtype=np.int8)
+    tokens_path = os.path.join(directory, f"tokens_{rows}_{seed}.npy")
+    labels_path = os.path.join(directory, f"labels_{rows}_{seed}.npy")
+    np.save(tokens_path, tokens)
+    np.save(labels_path, labels)
+    return TokenDataset(tokens_path, labels_path)
+
+def bench_amp(args):
+    """
+    Training throughput and peak memory for fp32, AMP and torch.compile variants of DetectionModelLSTM.
+    """
+    modes = {
+        'fp32': dict(amp=False, compile_model=False),
+        'amp': dict(amp=True, compile_model=False),
+        'compile': dict(amp=False, compile_model=True),
+        'amp+compile': dict(amp=True, compile_model=True),
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        dataset = make_token_dataset(args.rows, directory)
+        warmup = make_token_dataset(args.batch_size * args.warmup, directory, seed=1)
+
+        print(f"{'mode':<12} {'samples/sec':>12} {'peak RSS MB':>12} {'peak CUDA MB':>13}")
+        for name in args.modes:
+            config.update(modes[name], amp_dtype=args.amp_dtype)
+            torch.manual_seed(0)
+            model = bcudemo.prepare_model(DetectionModelLSTM(config))
+            optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4, weight_decay=1e-5)
+            criterion = nn.CrossEntropyLoss()
+            grad_scaler = bcudemo.build_grad_scaler()
+
+            # Warm-up epoch absorbs torch.compile and allocator start-up costs
+            bcudemo.train_epoch(model, bcudemo.build_loader(warmup, shuffle=True), optimizer, criterion, 0, grad_scaler=grad_scaler)
+
+            loader = bcudemo.build_loader(dataset, shuffle=True)
+            with PeakMemory() as memory:
+                start = time.perf_counter()
+                bcudemo.train_epoch(model, loader, optimizer, criterion, 0, grad_scaler=grad_scaler)
+                elapsed = time.perf_counter() - start
+            print(f"{name:<12} {args.rows / elapsed:>12.1f} {memory.peak_rss / 2**20:>12.1f} {memory.peak_cuda / 2**20:>13.1f}")
+
+def timed(fn, repeats):
+    """Mean wall-clock seconds per call of `fn` after one warm-up call."""
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats
+
+def bench_neighbour(args):
+    """
+    Parity and latency of the neighbor-average value lookup in GraphAvgColAmplifiedEmbedding:
+    reference gather+mean vs embedding_bag (training) vs cached window table (no grad).
+    Raises AssertionError if the fused paths drift from the reference.
+    """
+    torch.manual_seed(0)
+    embedding = GraphAvgColAmplifiedEmbedding(
+        config['vocab_size'], config['value_embedding_dim'], NUM_FEATURES,
+        config['position_embedding_dim'], config['amplify_embedding_dim'], k=config['nearest_neighbour']
+    ).to(device)
+    # Include indices at and beyond both ends of the vocabulary to exercise the clamped windows
+    indices = torch.randint(-50, config['vocab_size'] + 50, (args.batch_size, NUM_FEATURES), device=device)
+    indices[0, :4] = torch.tensor([0, 1, config['vocab_size'] - 1, config['vocab_size'] - 2])
+
+    reference = embedding.neighbour_average_reference(indices)
+    torch.testing.assert_close(embedding.neighbour_average(indices), reference)
+    with torch.no_grad():
+        torch.testing.assert_close(embedding.neighbour_average(indices), reference)
+
+    # Gradients reaching the embedding table must match as well
+    embedding.zero_grad()
+    embedding.neighbour_average_reference(indices).pow(2).sum().backward()
+    reference_grad = embedding.value_embedding.weight.grad.clone()
+    embedding.zero_grad()
+    embedding.neighbour_average(indices).pow(2).sum().backward()
+    torch.testing.assert_close(embedding.value_embedding.weight.grad, reference_grad)
+    print("parity: OK")
+
+    def train_step(lookup):
+        embedding.zero_grad()
+        lookup(indices).sum().backward()
+
+    results = {
+        'reference fwd+bwd': timed(lambda: train_step(embedding.neighbour_average_reference), args.repeats),
+        'embedding_bag fwd+bwd': timed(lambda: train_step(embedding.neighbour_average), args.repeats),
+    }
+    with torch.no_grad():
+        results['reference no-grad'] = timed(lambda: embedding.neighbour_average_reference(indices), args.repeats)
+        results['window table no-grad'] = timed(lambda: embedding.neighbour_average(indices), args.repeats)
+    for name, seconds in results.items():
+        print(f"{name:<24} {seconds * 1e3:>9.3f} ms/batch")
+
+def legacy_embedding_forward(embedding, discrete_indices):
+    """
+    GraphAvgColAmplifiedEmbedding.forward before the shared-adjacency change: per-call position
+    ids, an adjacency expanded to [batch, seq, seq] for bmm and a dimension assert in every layer.
+    """
+    batch_size, seq_len = discrete_indices.size()
+    value_embeddings = embedding.neighbour_average(discrete_indices)
+    position_ids = torch.arange(seq_len, device=discrete_indices.device).unsqueeze(0).repeat(batch_size, 1)
+    position_embeddings = embedding.position_embedding(position_ids)
+    amplified_embeddings = torch.cat((value_embeddings, position_embeddings), dim=-1)
+    adjacency_matrix = F.softmax(embedding.adjacency_weights, dim=-1).unsqueeze(0).expand(batch_size, -1, -1)
+    for layer in embedding.graph_layers:
+        amplified_embeddings = torch.bmm(adjacency_matrix, amplified_embeddings)
+        assert amplified_embeddings.size(-1) == layer.in_features
+        amplified_embeddings = embedding.dropout(F.relu(layer(amplified_embeddings)))
+    return torch.cat((value_embeddings, position_embeddings, amplified_embeddings), dim=-1)
+
+def bench_graph(args):
+    """
+    Latency of GraphAvgColAmplifiedEmbedding.forward against the version it replaced, for training
+    (fwd+bwd) and no-grad evaluation over several batch sizes, then of the two parts that changed on
+    their own: position embeddings (per-call ids + lookup vs a broadcast slice of the table) and the
+    no-grad adjacency (softmax per call vs the eval cache).
+    """
+    torch.manual_seed(0)
+    embedding = GraphAvgColAmplifiedEmbedding(
+        config['vocab_size'], config['value_embedding_dim'], NUM_FEATURES,
+        config['position_embedding_dim'], config['amplify_embedding_dim'], k=config['nearest_neighbour']
+    ).to(device)
+
+    print(f"{'batch':>6} {'mode':<8} {'legacy ms':>10} {'shared ms':>10} {'speedup':>8}")
+    for batch_size in args.batch_sizes:
+        indices = torch.randint(config['lower_bound'], config['upper_bound'], (batch_size, NUM_FEATURES), device=device)
+
+        embedding.eval()
+        with torch.no_grad():
+            torch.testing.assert_close(embedding(indices), legacy_embedding_forward(embedding, indices))
+            legacy = timed(lambda: legacy_embedding_forward(embedding, indices), args.repeats)
+            shared = timed(lambda: embedding(indices), args.repeats)
+        print(f"{batch_size:>6} {'no-grad':<8} {legacy * 1e3:>10.3f} {shared * 1e3:>10.3f} {legacy / shared:>7.2f}x")
+
+        embedding.train()
+        legacy = timed(lambda: legacy_embedding_forward(embedding, indices).sum().backward(), args.repeats)
+        shared = timed(lambda: embedding(indices).sum().backward(), args.repeats)
+        print(f"{batch_size:>6} {'train':<8} {legacy * 1e3:>10.3f} {shared * 1e3:>10.3f} {legacy / shared:>7.2f}x")
+
+    def position_ids(batch_size):
+        ids = torch.arange(NUM_FEATURES, device=device).unsqueeze(0).repeat(batch_size, 1)
+        return embedding.position_embedding(ids)
+
+    def position_slice(batch_size):
+        return embedding.position_embedding.weight[:NUM_FEATURES].unsqueeze(0).expand(batch_size, -1, -1)
+
+    embedding.eval()
+    softmax = lambda: F.softmax(embedding.adjacency_weights, dim=-1)
+    print(f"\n{'batch':>6} {'part':<18} {'legacy us':>10} {'new us':>10} {'speedup':>8}")
+    with torch.no_grad():
+        for batch_size in args.batch_sizes:
+            legacy = timed(lambda: position_ids(batch_size), args.repeats * 10)
+            new = timed(lambda: position_slice(batch_size), args.repeats * 10)
+            print(f"{batch_size:>6} {'position':<18} {legacy * 1e6:>10.1f} {new * 1e6:>10.1f} {legacy / new:>7.2f}x")
+        # The adjacency does not depend on the batch
+        legacy = timed(softmax, args.repeats * 10)
+        new = timed(lambda: embedding.eval_cache('adjacency', embedding.adjacency_weights, softmax), args.repeats * 10)
+        print(f"{'any':>6} {'adjacency softmax':<18} {legacy * 1e6:>10.1f} {new * 1e6:>10.1f} {legacy / new:>7.2f}x")
+
+def bench_attention(args):
+    """
+    Latency of StackedSelfAttention (one module per head) against FusedStackedSelfAttention with
+    and without scaled_dot_product_attention, after checking that all three agree (and that a
+    fused 'nystrom' stack matches its per-module source).
+    """
+    torch.manual_seed(0)
+    heads, hidden = config['num_attention_heads'], config['hidden_size']
+    layers = [
+        [AnomalyAwareSelfAttention(config) for _ in range(heads)],
+        [AnomalyAwareSelfAttention(dict(config, hidden_size=heads * hidden)) for _ in range(heads)],
+    ]
+    variants = {'per-module': StackedSelfAttention(layers).to(device)}
+    variants['fused'] = FusedStackedSelfAttention.from_stacked(variants['per-module'], config)
+    variants['fused+sdpa'] = FusedStackedSelfAttention.from_stacked(variants['per-module'], dict(config, attention_sdpa=True))
+
+    hidden_states = torch.randn(args.batch_size, NUM_FEATURES, hidden, device=device)
+    with torch.no_grad():
+        for module in variants.values():
+            module.eval()
+        reference = variants['per-module'](hidden_states)
+        for name in ('fused', 'fused+sdpa'):
+            torch.testing.assert_close(variants[name](hidden_states), reference, rtol=1e-4, atol=1e-4)
+        # The fused module must keep the landmark approximation of the modules it was built from
+        nystrom_config = dict(config, attention_mode='nystrom', num_landmarks=NUM_FEATURES // 2)
+        stacked = StackedSelfAttention([[AnomalyAwareSelfAttention(nystrom_config) for _ in range(heads)]]).to(device).eval()
+        fused = FusedStackedSelfAttention.from_stacked(stacked, config).eval()
+        torch.testing.assert_close(fused(hidden_states), stacked(hidden_states), rtol=1e-4, atol=1e-4)
+    print("parity: OK")
+
+    print(f"{'variant':<12} {'no-grad ms':>11} {'fwd+bwd ms':>11}")
+    for name, module in variants.items():
+        with torch.no_grad():
+            inference = timed(lambda: module(hidden_states), args.repeats)
+        module.train()
+        training = timed(lambda: module(hidden_states).sum().backward(), args.repeats)
+        print(f"{name:<12} {inference * 1e3:>11.3f} {training * 1e3:>11.3f}")
+
+def bench_landmarks(args):
+    """
+    Accuracy/latency tradeoff of the nystrom attention mode: relative error of the context against
+    exact attention and forward latency, per sequence length, landmark count and sampler.
+    """
+    torch.manual_seed(0)
+    exact = AnomalyAwareSelfAttention(config).to(device).eval()
+    print(f"{'seq_len':>7} {'mode':<18} {'rel. error':>10} {'ms':>9}")
+    for seq_len in args.seq_lens:
+        hidden_states = torch.randn(args.batch_size, seq_len, config['hidden_size'], device=device)
+        with torch.no_grad():
+            reference = exact(hidden_states)
+            print(f"{seq_len:>7} {'exact':<18} {0.0:>10.4f} {timed(lambda: exact(hidden_states), args.repeats) * 1e3:>9.3f}")
+            for sampler in ('max_norm', 'random'):
+                for landmarks in args.landmarks:
+                    if landmarks >= seq_len:
+                        continue
+                    approx = AnomalyAwareSelfAttention(dict(
+                        config, attention_mode='nystrom', num_landmarks=landmarks, landmark_sampler=sampler
+                    )).to(device).eval()
+                    approx.load_state_dict(exact.state_dict())
+                    error = ((approx(hidden_states) - reference).norm() / reference.norm()).item()
+                    latency = timed(lambda: approx(hidden_states), args.repeats)
+                    print(f"{seq_len:>7} {f'{sampler} m={landmarks}':<18} {error:>10.4f} {latency * 1e3:>9.3f}")
+
+def bench_search(args):
+    """
+    Wall time and chosen top-4 learning rates of the full-fidelity LR search against the
+    multi-fidelity search ('search_fidelity'), on the same learnable synthetic data and trial budget.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        bcudemo.train_loader = bcudemo.build_loader(make_token_dataset(args.rows, directory, seed=0, learnable=True), shuffle=True)
+        bcudemo.test_loader = bcudemo.build_loader(make_token_dataset(args.rows // 4, directory, seed=1, learnable=True), shuffle=False)
+        config.update(n_trials=args.trials, search_workers=1, study_storage=os.path.join(directory, "journal.log"))
+
+        results = {}
+        for name, fidelity in (('full', False), ('multi-fidelity', True)):
+            config.update(search_fidelity=fidelity, study_name=f"bench_{name}")
+            bcudemo.fidelity_loaders = None
+            torch.manual_seed(0)
+            start = time.perf_counter()
+            bcudemo.run_search_worker(seed=0)  # Same TPE seed, so both searches start from the same learning rates
+            elapsed = time.perf_counter() - start
+            study = bcudemo.load_study()
+            pruned = sum(trial.state == bcudemo.optuna.trial.TrialState.PRUNED for trial in study.trials)
+            results[name] = bcudemo.select_learning_rates(study)[1]
+            print(f"{name:<15} {elapsed:>8.1f} s  pruned {pruned}/{len(study.trials)}  top-4 {[f'{lr:.2e}' for lr in results[name]]}")
+
+        # Distance of each multi-fidelity pick to the closest full-fidelity pick, in decades of learning rate
+        full = np.log10(results['full'])
+        gaps = [np.abs(full - np.log10(lr)).min() for lr in results['multi-fidelity']]
+        print(f"max |log10 lr gap| to the full search: {max(gaps):.3f}")
+
+def optimizer_state_bytes(optimizer):
+    return sum(
+        value.numel() * value.element_size()
+        for inner in getattr(optimizer, 'optimizers', (optimizer,))
+        for state in inner.state.values() for value in state.values() if torch.is_tensor(value)
+    )
+
+def gradient_bytes(model):
+    total = 0
+    for p in model.parameters():
+        if p.grad is None:
+            continue
+        grad = p.grad.coalesce() if p.grad.is_sparse else p.grad
+        total += sum(t.numel() * t.element_size() for t in ((grad.indices(), grad.values()) if grad.is_sparse else (grad,)))
+    return total
+
+def make_column_tokens(rows, cardinality, seed=0):
+    """Synthetic token rows where each column draws from its own `cardinality` token values, like scaled flow features."""
+    rng = np.random.default_rng(seed)
+    columns = [rng.choice(np.arange(config['lower_bound'], config['upper_bound']), cardinality, replace=False) for _ in range(NUM_FEATURES)]
+    return np.stack([rng.choice(column, rows) for column in columns], axis=1)
+
+def bench_vocabulary(args):
+    """
+    Full 150100-row value embedding against the compact TokenVocabulary embedding: parameter and
+    AdamW state memory, training step time, and parity of the outputs on the same windows.
+    Raises AssertionError if the compact model drifts from the full one.
+    """
+    if args.tokens:
+        tokens = np.load(args.tokens, mmap_mode='r')[:args.rows].astype(np.int64)
+    else:
+        # Each column draws from its own small set of token values, like the scaled flow features
+        tokens = make_column_tokens(args.rows, args.cardinality)
+    config['sequence_length'] = tokens.shape[1]
+    vocabulary = TokenVocabulary().fit(tokens)
+    print(f"{vocabulary.num_tokens} observed tokens, {vocabulary.num_rows} embedding rows (of {config['vocab_size']})")
+
+    torch.manual_seed(0)
+    full = DetectionModelLSTM(config).to(device).eval()
+    compact = DetectionModelLSTM(config, window_rows=vocabulary.window_rows).to(device).eval()
+    state = full.state_dict()
+    state['embedding.value_embedding.weight'] = state['embedding.value_embedding.weight'][torch.from_numpy(vocabulary.rows).to(device)]
+    state['embedding.window_rows'] = compact.embedding.window_rows
+    compact.load_state_dict(state)
+
+    batch = torch.from_numpy(tokens[:args.batch_size]).to(device)
+    compact_batch = torch.from_numpy(vocabulary.encode(batch.cpu().numpy())).to(device)
+    with torch.no_grad():
+        torch.testing.assert_close(compact(compact_batch), full(batch))
+    torch.testing.assert_close(compact.embedding.neighbour_average(compact_batch), full.embedding.neighbour_average(batch))
+    print("parity: OK")
+
+    labels = torch.randint(0, len(bcudemo.LABEL_MAPPING), (len(batch),), device=device)
+    criterion = nn.CrossEntropyLoss()
+    print(f"{'embedding':<10} {'params MB':>10} {'AdamW state MB':>15} {'ms/step':>9}")
+    for name, model, inputs in (('full', full, batch), ('compact', compact, compact_batch)):
+        model.train()
+        optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4, weight_decay=1e-5)
+
+        def train_step():
+            optimizer.zero_grad()
+            criterion(model(inputs), labels).backward()
+            optimizer.step()
+
+        seconds = timed(train_step, args.repeats)
+        params = sum(p.numel() * p.element_size() for p in model.parameters())
+        print(f"{name:<10} {params / 2**20:>10.1f} {optimizer_state_bytes(optimizer) / 2**20:>15.1f} {seconds * 1e3:>9.1f}")
+
+def bench_sparse(args):
+    """
+    Dense AdamW against sparse value-embedding gradients with SplitOptimizer (SparseAdam + AdamW):
+    training step time of the full model and of the embedding alone, gradient and optimizer memory.
+    Raises AssertionError if the sparse embedding gradient differs from the dense one.
+    """
+    config['sequence_length'] = NUM_FEATURES
+    batch = torch.from_numpy(make_column_tokens(args.batch_size, args.cardinality)).to(device)
+    labels = torch.randint(0, len(bcudemo.LABEL_MAPPING), (args.batch_size,), device=device)
+    criterion = nn.CrossEntropyLoss()
+    print(f"{len(torch.unique(batch))} distinct tokens per batch")
+
+    def build(sparse):
+        config['sparse_embedding'] = sparse
+        torch.manual_seed(0)
+        return DetectionModelLSTM(config).to(device)
+
+    # The sparse gradient must equal the dense one; only the optimizer update differs
+    gradients = []
+    for sparse in (False, True):
+        model = build(sparse)
+        model.embedding.neighbour_average(batch).pow(2).sum().backward()
+        grad = model.embedding.value_embedding.weight.grad
+        gradients.append(grad.to_dense() if grad.is_sparse else grad)
+    torch.testing.assert_close(gradients[1], gradients[0])
+    print("gradient parity: OK")
+
+    print(f"{'optimizer':<22} {'model ms/step':>14} {'embedding ms/step':>18} {'grad MB':>8} {'optimizer state MB':>19}")
+    for name, sparse in (('dense AdamW', False), ('SparseAdam + AdamW', True)):
+        model = build(sparse).train()
+        optimizer = bcudemo.build_optimizer(model, 1e-4)
+
+        def model_step():
+            optimizer.zero_grad()
+            criterion(model(batch), labels).backward()
+            optimizer.step()
+
+        def embedding_step():
+            optimizer.zero_grad()
+            model.embedding(batch).sum().backward()
+            optimizer.step()
+
+        model_seconds = timed(model_step, args.repeats)
+        embedding_seconds = timed(embedding_step, args.repeats)
+        model_step()
+        print(f"{name:<22} {model_seconds * 1e3:>14.1f} {embedding_seconds * 1e3:>18.1f} "
+              f"{gradient_bytes(model) / 2**20:>8.1f} {optimizer_state_bytes(optimizer) / 2**20:>19.1f}")
+    print("SparseAdam keeps dense moment buffers, so optimizer state is the same size for both")
+
+def bench_dedup(args):
+    """
+    Flood-like scoring: `rows` flows drawn from `unique_rows` distinct token rows, scored chunk by chunk
+    with predict_tokens, with per-chunk deduplication, and with deduplication plus the LRU result cache.
+    Raises AssertionError if a deduplicated prediction differs from the plain one.
+    """
+    import inference
+
+    config['sequence_length'] = NUM_FEATURES
+    torch.manual_seed(0)
+    model = DetectionModelLSTM(config).to(device).eval()
+    rng = np.random.default_rng(0)
+    distinct = make_column_tokens(args.unique_rows, args.cardinality)
+    tokens = distinct[rng.integers(0, args.unique_rows, args.rows)]
+    chunks = [tokens[start:start + args.chunk_rows] for start in range(0, args.rows, args.chunk_rows)]
+
+    variants = {
+        'plain': lambda chunk, cache: inference.predict_tokens(model, chunk, args.batch_size),
+        'dedup': lambda chunk, cache: inference.predict_unique(model, chunk, args.batch_size)[:2],
+        'dedup + LRU cache': lambda chunk, cache: inference.predict_unique(model, chunk, args.batch_size, cache)[:2],
+    }
+    reference = None
+    print(f"{'mode':<20} {'flows/sec':>10}")
+    for name, predict in variants.items():
+        cache = inference.PredictionCache(args.unique_rows)
+        start = time.perf_counter()
+        predictions = np.concatenate([predict(chunk, cache)[0] for chunk in chunks])
+        elapsed = time.perf_counter() - start
+        if reference is None:
+            reference = predictions
+        assert np.array_equal(predictions, reference), f"{name}: predictions differ from the plain pass"
+        print(f"{name:<20} {args.rows / elapsed:>10.1f}")
+
+def bench_weighted(args):
+    """
+    Training on the full duplicated split against the weighted-unique split (distinct rows with counts):
+    epoch time, and evaluate() metrics on both forms of the same data.
+    Raises AssertionError if accuracy or the confusion matrix differ.
+    """
+    rng = np.random.default_rng(0)
+    distinct = make_column_tokens(args.unique_rows, args.cardinality)
+    distinct_labels = rng.integers(0, len(bcudemo.LABEL_MAPPING), args.unique_rows).astype(np.int8)
+    # Heavy-tailed duplication, as flood classes repeat a few rows very often
+    picks = np.minimum(rng.zipf(1.5, args.rows) - 1, args.unique_rows - 1)
+    tokens, labels = distinct[picks], distinct_labels[picks]
+    unique_tokens, unique_labels, counts = bcudemo.fold_duplicates(tokens, labels)
+    print(f"{len(counts)} distinct rows of {args.rows} ({args.rows / len(counts):.1f}x duplication)")
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = {}
+        for name, array in (('tokens', tokens), ('labels', labels), ('unique_tokens', unique_tokens),
+                            ('unique_labels', unique_labels), ('counts', counts.astype(np.int32))):
+            paths[name] = os.path.join(directory, f"{name}.npy")
+            np.save(paths[name], array)
+        datasets = {
+            'full': TokenDataset(paths['tokens'], paths['labels']),
+            'weighted-unique': TokenDataset(paths['unique_tokens'], paths['unique_labels'], paths['counts']),
+        }
+
+        config['sequence_length'] = NUM_FEATURES
+        criterion = nn.CrossEntropyLoss()
+        metrics = {}
+        print(f"{'data':<16} {'epoch s':>8} {'eval loss':>10} {'eval acc':>9}")
+        for name, dataset in datasets.items():
+            torch.manual_seed(0)
+            model = DetectionModelLSTM(config).to(device)
+            optimizer = bcudemo.build_optimizer(model, 1e-4)
+            start = time.perf_counter()
+            bcudemo.train_epoch(model, bcudemo.build_loader(dataset, shuffle=True), optimizer, criterion, 0)
+            elapsed = time.perf_counter() - start
+
+            # Score one fixed model on both forms of the data, so the metrics must agree exactly
+            if not metrics:
+                reference_model = model
+            loaders = {key: bcudemo.build_loader(data, shuffle=False) for key, data in datasets.items()}
+            loss, accuracy, evaluation = bcudemo.evaluate(reference_model, loaders[name], criterion, len(bcudemo.LABEL_MAPPING))
+            metrics[name] = (accuracy, evaluation.confusion_matrix())
+            print(f"{name:<16} {elapsed:>8.1f} {loss:>10.4f} {accuracy:>8.2f}%")
+
+    assert metrics['full'][0] == metrics['weighted-unique'][0], "accuracy differs"
+    assert np.array_equal(metrics['full'][1], metrics['weighted-unique'][1]), "confusion matrix differs"
+    print("evaluate parity: OK")
+
+def bench_metrics(args):
+    """
+    Metrics over `rows` predictions in batches: gathering predictions and calling sklearn's
+    confusion_matrix (once for the metrics, once more for the plot, as evaluate/final_training did)
+    against ClassificationMetrics. Raises AssertionError if the matrix, precision, recall or F1 differ from sklearn.
+    """
+    from sklearn.metrics import confusion_matrix, f1_score, precision_recall_fscore_support
+
+    num_classes = len(bcudemo.LABEL_MAPPING)
+    generator = torch.Generator(device='cpu').manual_seed(0)
+    # The last class never occurs; the three before it occur but are never predicted
+    targets = torch.randint(0, num_classes - 1, (args.rows,), generator=generator).to(device)
+    predicted_classes = num_classes - 4
+    correct = (torch.rand(args.rows, generator=generator).to(device) < 0.7) & (targets < predicted_classes)
+    predictions = torch.where(correct, targets, torch.randint(0, predicted_classes, (args.rows,), generator=generator).to(device))
+    batches = list(zip(predictions.split(args.batch_size), targets.split(args.batch_size)))
+
+    def gathered():
+        all_preds, all_targets = [], []
+        for batch_preds, batch_targets in batches:
+            all_preds.extend(batch_preds.cpu().numpy())
+            all_targets.extend(batch_targets.cpu().numpy())
+        cm = confusion_matrix(all_targets, all_preds, labels=range(num_classes))
+        confusion_matrix(all_targets, all_preds)  # Recomputed for the plot
+        return cm
+
+    def preallocated():
+        all_preds = torch.empty(args.rows, dtype=torch.long, device=device)
+        all_targets = torch.empty(args.rows, dtype=torch.long, device=device)
+        offset = 0
+        for batch_preds, batch_targets in batches:
+            all_preds[offset:offset + len(batch_preds)] = batch_preds
+            all_targets[offset:offset + len(batch_preds)] = batch_targets
+            offset += len(batch_preds)
+        all_preds, all_targets = all_preds.cpu().numpy(), all_targets.cpu().numpy()
+        cm = confusion_matrix(all_targets, all_preds, labels=range(num_classes))
+        confusion_matrix(all_targets, all_preds)
+        return cm
+
+    def accumulated():
+        metrics = bcudemo.ClassificationMetrics(num_classes)
+        for batch_preds, batch_targets in batches:
+            metrics.update(batch_preds, batch_targets)
+        cm = metrics.confusion_matrix()
+        return metrics, cm, metrics.summary(cm)
+
+    metrics, cm, summary = accumulated()
+    y_true, y_pred = targets.cpu().numpy(), predictions.cpu().numpy()
+    assert np.array_equal(cm, confusion_matrix(y_true, y_pred, labels=range(num_classes)))
+    # sklearn scores 0 where a class has support but no predictions; only classes absent from both are NaN here
+    precision, _, f1, _ = precision_recall_fscore_support(y_true, y_pred, labels=range(num_classes), zero_division=0)
+    _, recall, _, _ = precision_recall_fscore_support(y_true, y_pred, labels=range(num_classes), zero_division=np.nan)
+    absent = (cm.sum(axis=0) == 0) & (cm.sum(axis=1) == 0)
+    precision, f1 = np.where(absent, np.nan, precision), np.where(absent, np.nan, f1)
+    for name, expected in (('precision', precision), ('recall', recall), ('f1', f1)):
+        np.testing.assert_allclose(summary[name], expected, equal_nan=True, err_msg=name)
+    np.testing.assert_allclose(summary['macro_f1'], f1_score(y_true, y_pred, average='macro'), err_msg='macro_f1')
+    print("sklearn parity: OK")
+
+    for name, fn in (('lists + sklearn', gathered), ('tensors + sklearn', preallocated), ('ClassificationMetrics', accumulated)):
+        print(f"{name:<22} {timed(fn, args.repeats) * 1e3:>9.1f} ms")
+
+def make_flows(rows, seed=0):
+    """
+    Synthetic raw flows: `rows` x NUM_FEATURES heavy-tailed features (log-normal, with 10% zero
+    counters) and labels drawn uniformly from all classes.
+    """
+    rng = np.random.default_rng(seed)
+    features = rng.lognormal(mean=3, sigma=2, size=(rows, NUM_FEATURES))
+    features[rng.random(features.shape) < 0.1] = 0
+    labels = rng.integers(0, len(bcudemo.LABEL_MAPPING), size=rows)
+    return features, labels
+
+def measure(fn, repeats, items=1):
+    """
+    Latency percentiles of `repeats` calls of `fn` (after one warm-up call), throughput in items/sec
+    at the median latency, and peak RSS over the timed calls.
+    """
+    fn()
+    start_rss = psutil.Process().memory_info().rss
+    times = np.empty(repeats)
+    with PeakMemory() as memory:
+        for i in range(repeats):
+            start = time.perf_counter()
+            fn()
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            times[i] = time.perf_counter() - start
+    p50, p90, p99 = np.percentile(times, [50, 90, 99]) * 1e3
+    return {
+        'p50_ms': p50,
+        'p90_ms': p90,
+        'p99_ms': p99,
+        'mean_ms': times.mean() * 1e3,
+        'items_per_sec': items / np.median(times),
+        'peak_rss_mb': memory.peak_rss / 2**20,
+        'rss_growth_mb': (memory.peak_rss - start_rss) / 2**20,
+        'peak_cuda_mb': memory.peak_cuda / 2**20,
+    }
+
+def suite_cases(args, directory):
+    """
+    (name, fn, items per call) for each suite case, all built from seeded synthetic data.
+    Scaler cases run on `rows` raw flows; model cases on one `batch_size` batch of their tokens;
+    evaluate on `eval_rows` rows.
+    """
+    features, labels = make_flows(args.rows)
+    scaler = bcudemo.DSRMMCustomScaler(params_file=os.path.join(directory, "scaling_parameters.json"))
+    scaler.fit(features)
+    tokens = scaler.transform_tokens(features, dtype=np.int64)
+
+    torch.manual_seed(0)
+    model = DetectionModelLSTM(config).to(device)
+    criterion = nn.CrossEntropyLoss()
+    batch = torch.from_numpy(tokens[:args.batch_size]).to(device)
+    batch_labels = torch.from_numpy(labels[:args.batch_size]).to(device)
+    embedding = model.embedding
+    attention = AnomalyAwareSelfAttention(config).to(device).eval()
+    hidden_states = torch.randn(args.batch_size, NUM_FEATURES, config['hidden_size'], device=device)
+
+    eval_rows = min(args.eval_rows, args.rows)
+    np.save(os.path.join(directory, "suite_tokens.npy"), tokens[:eval_rows].astype(np.int32))
+    np.save(os.path.join(directory, "suite_labels.npy"), labels[:eval_rows].astype(np.int8))
+    eval_loader = bcudemo.build_loader(
+        TokenDataset(os.path.join(directory, "suite_tokens.npy"), os.path.join(directory, "suite_labels.npy")), shuffle=False
+    )
+
+    def embedding_forward():
+        embedding.train()
+        embedding(batch)
+
+    def attention_forward():
+        with torch.no_grad():
+            attention(hidden_states)
+
+    def model_forward():
+        model.eval()
+        with torch.no_grad():
+            model(batch)
+
+    def model_forward_backward():
+        model.train()
+        model.zero_grad()
+        criterion(model(batch), batch_labels).backward()
+
+    return [
+        ('scaler.fit', lambda: scaler.fit(features), args.rows),
+        ('scaler.transform_tokens', lambda: scaler.transform_tokens(features), args.rows),
+        ('shrink_outliers', lambda: scaler.shrink_outliers(features, scaler.lower_bound, scaler.upper_bound), args.rows),
+        ('embedding.forward', embedding_forward, args.batch_size),
+        ('attention.forward', attention_forward, args.batch_size),
+        ('model.forward', model_forward, args.batch_size),
+        ('model.forward_backward', model_forward_backward, args.batch_size),
+        ('evaluate', lambda: bcudemo.evaluate(model, eval_loader, criterion, len(bcudemo.LABEL_MAPPING)), eval_rows),
+    ]
+
+SUITE_CASES = (
+    'scaler.fit', 'scaler.transform_tokens', 'shrink_outliers', 'embedding.forward', 'attention.forward',
+    'model.forward', 'model.forward_backward', 'evaluate',
+)
+
+def suite_environment(args):
+    """Settings a baseline is only comparable under."""
+    return {
+        'rows': args.rows,
+        'batch_size': args.batch_size,
+        'eval_rows': args.eval_rows,
+        'repeats': args.repeats,
+        'threads': torch.get_num_threads(),
+        'device': str(device),
+        'torch': torch.__version__,
+        'numpy': np.__version__,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+    }
+
+def compare_to_baseline(results, baseline, tolerance):
+    """
+    Print each case's median latency against `baseline` and return the cases more than `tolerance` slower.
+    """
+    print(f"{'case':<24} {'base p50':>9} {'p50':>9} {'change':>8}")
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            print(f"{name:<24} {'-':>9} {result['p50_ms']:>9.2f} {'new':>8}")
+            continue
+        change = result['p50_ms'] / baseline[name]['p50_ms'] - 1
+        flag = ""
+        if change > tolerance:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:<24} {baseline[name]['p50_ms']:>9.2f} {result['p50_ms']:>9.2f} {change:>+8.1%}{flag}")
+    return regressions
+
+def bench_suite(args):
+    """
+    Latency percentiles, throughput and memory of the pipeline's hot paths on seeded synthetic data.
+    --save-baseline writes the results and environment to JSON; --compare checks a run against such a
+    file and exits with status 1 if any case's median latency grew by more than --tolerance.
+    """
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    cases = args.cases or SUITE_CASES
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        print(f"{'case':<24} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'items/sec':>11} {'peak RSS MB':>12} {'RSS +MB':>8}")
+        for name, fn, items in suite_cases(args, directory):
+            if name not in cases:
+                continue
+            result = results[name] = measure(fn, args.repeats, items)
+            print(f"{name:<24} {result['p50_ms']:>9.2f} {result['p90_ms']:>9.2f} {result['p99_ms']:>9.2f} "
+                  f"{result['items_per_sec']:>11.1f} {result['peak_rss_mb']:>12.1f} {result['rss_growth_mb']:>8.1f}")
+
+    environment = suite_environment(args)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump({'environment': environment, 'results': results}, f, indent=4, default=float)
+        print(f"Baseline saved to {args.save_baseline}")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        for key, value in environment.items():
+            if baseline['environment'].get(key) != value:
+                print(f"warning: {key} differs from the baseline ({baseline['environment'].get(key)} vs {value})")
+        regressions = compare_to_baseline(results, baseline['results'], args.tolerance)
+        if regressions:
+            raise SystemExit(f"{len(regressions)} case(s) slower than the baseline by more than {args.tolerance:.0%}: {', '.join(regressions)}")
+
+BENCHMARKS = {
+    'amp': bench_amp,
+    'neighbour': bench_neighbour,
+    'graph': bench_graph,
+    'attention': bench_attention,
+    'landmarks': bench_landmarks,
+    'search': bench_search,
+    'vocabulary': bench_vocabulary,
+    'sparse': bench_sparse,
+    'dedup': bench_dedup,
+    'weighted': bench_weighted,
+    'metrics': bench_metrics,
+    'suite': bench_suite,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--rows", type=int, default=8192, help="Synthetic rows per measured epoch")
+    parser.add_argument("--batch-size", type=int, default=config['batch_size'])
+    parser.add_argument("--warmup", type=int, default=2, help="Warm-up batches before measuring")
+    parser.add_argument("--modes", nargs="+", default=['fp32', 'amp'], help="amp: fp32, amp, compile, amp+compile")
+    parser.add_argument("--amp-dtype", default=config['amp_dtype'])
+    parser.add_argument("--repeats", type=int, default=20, help="Timed calls per micro-benchmark")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[64, 256, 1024], help="graph: batch sizes to sweep")
+    parser.add_argument("--seq-lens", type=int, nargs="+", default=[NUM_FEATURES, 512, 2048], help="landmarks: sequence lengths")
+    parser.add_argument("--landmarks", type=int, nargs="+", default=[8, 16, 32], help="landmarks: landmark counts m")
+    parser.add_argument("--trials", type=int, default=12, help="search: Optuna trials per search")
+    parser.add_argument("--tokens", help="vocabulary: raw token .npy (e.g. X_train_scaled.npy) instead of synthetic columns")
+    parser.add_argument("--cardinality", type=int, default=500, help="vocabulary, sparse: distinct tokens per synthetic column")
+    parser.add_argument("--unique-rows", type=int, default=500, help="dedup, weighted: distinct token rows among --rows flows")
+    parser.add_argument("--chunk-rows", type=int, default=4096, help="dedup: flows per scored chunk")
+    parser.add_argument("--cases", nargs="+", choices=SUITE_CASES, help="suite: cases to run (default: all)")
+    parser.add_argument("--eval-rows", type=int, default=1024, help="suite: rows scored per evaluate call")
+    parser.add_argument("--threads", type=int, help="suite: torch intra-op threads (default: torch's choice)")
+    parser.add_argument("--save-baseline", help="suite: write the results to this JSON file")
+    parser.add_argument("--compare", help="suite: baseline JSON to compare the results against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="suite: allowed median-latency growth before a case regresses")
+    args = parser.parse_args()
+
+    config['batch_size'] = args.batch_size
+    config['sequence_length'] = NUM_FEATURES
+    BENCHMARKS[args.benchmark](args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""
+Export a trained DetectionModelLSTM for CPU serving.
+
+Builds an inference-only copy of the model whose neighbor-averaged value table is precomputed
+and optionally stored as per-row int8 or fp16, applies dynamic int8 quantization to the LSTM and
+Linear layers, writes a TorchScript (or ONNX) artifact, and reports parity against the fp32 model
+on the test split together with latency and size. Run from this directory:
+    python export.py --checkpoint checkpoints/best.pt --embedding int8 --output detection_model.ts
+    python export.py --embedding fp16 --no-quantize --format onnx --output detection_model.onnx
+"""
+import argparse
+import copy
+import io
+import os
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from inference import load_model
+
+class ExportedEmbedding(nn.Module):
+    """
+    Inference-only GraphAvgColAmplifiedEmbedding.
+
+    The neighbor-window mean of every index is precomputed (build_window_table) and stored as
+    fp32, fp16, or int8 with a per-row scale and offset; the softmaxed adjacency is frozen.
+    The forward pass is a single row gather plus the graph layers, with no Python-side caches,
+    so it traces cleanly.
+    """
+    def __init__(self, embedding, table_dtype='fp32'):
+        super(ExportedEmbedding, self).__init__()
+        with torch.no_grad():
+            table = embedding.build_window_table().float()
+            adjacency = F.softmax(embedding.adjacency_weights, dim=-1)
+
+        # Same index -> table row mapping as GraphAvgColAmplifiedEmbedding.table_indices
+        self.table_dtype = table_dtype
+        if embedding.window_rows is not None:
+            self.index_min, self.index_max, self.index_offset = 0, embedding.window_rows.size(0) - 1, 0
+        else:
+            self.index_min = -embedding.window_high
+            self.index_max = embedding.vocab_size - 1 - embedding.window_low
+            self.index_offset = embedding.window_high
+
+        if table_dtype == 'int8':
+            # Per-row affine quantization (like float_qparams embeddings): row = offset + scale * code
+            low = table.min(dim=1, keepdim=True).values
+            high = table.max(dim=1, keepdim=True).values
+            scale = ((high - low) / 255).clamp_min(1e-12)
+            self.register_buffer('table', torch.round((table - low) / scale).to(torch.uint8))
+            self.register_buffer('table_scale', scale)
+            self.register_buffer('table_offset', low)
+        elif table_dtype == 'fp16':
+            self.register_buffer('table', table.half())
+        elif table_dtype == 'fp32':
+            self.register_buffer('table', table)
+        else:
+            raise ValueError(f"Unknown embedding dtype {table_dtype!r}, expected 'fp32', 'fp16' or 'int8'.")
+
+        self.register_buffer('position', embedding.position_embedding.weight.detach().clone())
+        self.register_buffer('adjacency', adjacency.detach().clone())
+        self.graph_layers = copy.deepcopy(embedding.graph_layers)
+
+    def lookup(self, table_indices):
+        rows = self.table[table_indices]
+        if self.table_dtype == 'int8':
+            return rows.float() * self.table_scale[table_indices] + self.table_offset[table_indices]
+        return rows.float()
+
+    def forward(self, discrete_indices):
+        batch_size, seq_len = discrete_indices.size()
+
+        # Neighbor-window mean of every index: one gather from the precomputed table
+        table_indices = discrete_indices.round().long().clamp(self.index_min, self.index_max) + self.index_offset
+        value_embeddings = self.lookup(table_indices)
+
+        position_embeddings = self.position[:seq_len].unsqueeze(0).expand(batch_size, -1, -1)
+        node_features = torch.cat((value_embeddings, position_embeddings), dim=-1)
+
+        adjacency_matrix = self.adjacency.expand(batch_size, -1, -1)
+        amplified_embeddings = node_features
+        for layer in self.graph_layers:
+            amplified_embeddings = F.relu(layer(torch.bmm(adjacency_matrix, amplified_embeddings)))
+
+        return torch.cat((value_embeddings, position_embeddings, amplified_embeddings), dim=-1)
+
+def build_export_model(model, embedding_dtype='int8', quantize=True):
+    """
+    CPU inference copy of `model` with the exported embedding and, optionally, dynamic int8 LSTM/Linear layers.
+    """
+    exported = copy.deepcopy(model).cpu().eval()
+    exported.embedding = ExportedEmbedding(exported.embedding, embedding_dtype)
+    if quantize:
+        exported = torch.ao.quantization.quantize_dynamic(exported, {nn.LSTM, nn.Linear}, dtype=torch.qint8)
+    return exported.eval()
+
+def serialized_size(model):
+    """Bytes of the model's state_dict as torch.save would write it."""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+def predict_logits(model, tokens, batch_size):
+    outputs = []
+    with torch.inference_mode():
+        for start in range(0, len(tokens), batch_size):
+            outputs.append(model(tokens[start:start + batch_size]).float())
+    return torch.cat(outputs)
+
+def batch_latency(model, batch, repeats):
+    """Mean seconds per forward pass of `batch` after one warm-up call."""
+    with torch.inference_mode():
+        model(batch)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            model(batch)
+    return (time.perf_counter() - start) / repeats
+
+def export_artifact(model, example, output, output_format):
+    if output_format == 'torchscript':
+        with torch.inference_mode():
+            traced = torch.jit.trace(model, example, check_trace=False)
+        traced.save(output)
+        return torch.jit.load(output)
+    if output_format == 'onnx':
+        torch.onnx.export(
+            model, (example,), output, input_names=['tokens'], output_names=['logits'],
+            dynamic_axes={'tokens': {0: 'batch'}, 'logits': {0: 'batch'}}
+        )
+        return None
+    raise ValueError(f"Unknown format {output_format!r}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--checkpoint", default=os.path.join("checkpoints", "best.pt"))
+    parser.add_argument("--tokens", default="X_test_scaled.npy", help="Test-split tokens for the parity report")
+    parser.add_argument("--labels", default="y_test.npy", help="Test-split labels for the parity report")
+    parser.add_argument("--embedding", choices=['fp32', 'fp16', 'int8'], default='int8', help="Storage of the value table")
+    parser.add_argument("--no-quantize", action="store_true", help="Keep LSTM/Linear layers in fp32")
+    parser.add_argument("--format", choices=['torchscript', 'onnx'], default='torchscript')
+    parser.add_argument("--output", default="detection_model.ts")
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--repeats", type=int, default=10, help="Timed forward passes per variant")
+    args = parser.parse_args()
+    if args.format == 'onnx' and not args.no_quantize:
+        parser.error("ONNX export does not support dynamically quantized LSTMs; add --no-quantize")
+
+    tokens = torch.from_numpy(np.load(args.tokens).astype(np.int64))
+    labels = torch.from_numpy(np.load(args.labels).astype(np.int64))
+    reference_model = load_model(args.checkpoint, tokens.shape[1]).cpu()
+
+    variants = {'fp32': reference_model}
+    variants[f"embedding {args.embedding}"] = build_export_model(reference_model, args.embedding, quantize=False)
+    if not args.no_quantize:
+        variants[f"int8 dynamic + embedding {args.embedding}"] = build_export_model(reference_model, args.embedding, quantize=True)
+    export_name = list(variants)[-1]
+
+    artifact = export_artifact(variants[export_name], tokens[:args.batch_size], args.output, args.format)
+    if artifact is not None:
+        variants[f"{args.format} artifact"] = artifact
+
+    reference_logits = predict_logits(reference_model, tokens, args.batch_size)
+    reference_predictions = reference_logits.argmax(dim=-1)
+    batch = tokens[:args.batch_size]
+
+    print(f"Exported '{export_name}' to {args.output} ({os.path.getsize(args.output) / 2**20:.1f} MB)")
+    print(f"{'variant':<36} {'accuracy':>9} {'agree':>8} {'max |dlogit|':>13} {'ms/batch':>9} {'size MB':>8}")
+    for name, model in variants.items():
+        logits = predict_logits(model, tokens, args.batch_size)
+        predictions = logits.argmax(dim=-1)
+        accuracy = (predictions == labels).float().mean().item() * 100
+        agreement = (predictions == reference_predictions).float().mean().item() * 100
+        max_diff = (logits - reference_logits).abs().max().item()
+        latency = batch_latency(model, batch, args.repeats) * 1e3
+        size = serialized_size(model) / 2**20
+        print(f"{name:<36} {accuracy:>8.2f}% {agreement:>7.2f}% {max_diff:>13.2e} {latency:>9.2f} {size:>8.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+"""
+Offline batch inference for a trained DetectionModelLSTM.
+
+Loads the fitted DSRMMCustomScaler parameters and a model checkpoint written by
+bcudemo.py, then classifies a CSV or .npy file of flows chunk by chunk. Run from this directory:
+    python inference.py flows.csv --checkpoint checkpoints/best.pt --output predictions.csv
+    python inference.py flows.npy --scaler scaling_parameters.json --batch-size 8192
+    python inference.py flood.csv --dedup --cache-size 100000
+"""
+import argparse
+import collections
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+
+import bcudemo
+from bcudemo import config, device, DetectionModelLSTM, DSRMMCustomScaler, LABEL_MAPPING, TokenVocabulary, vocabulary_path
+
+# Class index -> label name
+LABEL_NAMES = np.array(sorted(LABEL_MAPPING, key=LABEL_MAPPING.get))
+
+def load_scaler(params_file):
+    """
+    DSRMMCustomScaler with its parameters loaded explicitly from `params_file` (never refitted).
+    """
+    if not os.path.exists(params_file):
+        raise FileNotFoundError(f"Scaling parameters not found: {params_file}")
+    scaler = DSRMMCustomScaler(params_file=params_file)
+    scaler.load_scale_dict(params_file)
+    if not scaler.scale_dict:
+        raise ValueError(f"No scaling parameters in {params_file}")
+    return scaler
+
+def load_model(checkpoint_path, num_features):
+    """
+    Rebuild DetectionModelLSTM from a bcudemo.py checkpoint (or a bare state_dict) in eval mode.
+    """
+    checkpoint = torch.load(checkpoint_path, map_location='cpu', weights_only=False)
+    if isinstance(checkpoint, dict) and 'model' in checkpoint:
+        # Training checkpoints carry the config the model was built with
+        config.update(checkpoint.get('config', {}))
+        state_dict = checkpoint['model']
+    else:
+        state_dict = checkpoint
+    config['sequence_length'] = num_features
+    config['embedding_dim'] = config['value_embedding_dim'] + config['position_embedding_dim'] + config['amplify_embedding_dim']
+
+    # Compact-vocabulary checkpoints carry their window rows, so the model itself needs no vocabulary file;
+    # the state_dict, not the (possibly default) config, decides whether inputs are compact ids
+    window_rows = state_dict.get('embedding.window_rows')
+    config['compact_vocabulary'] = window_rows is not None
+    model = DetectionModelLSTM(config, window_rows=window_rows)
+    model.load_state_dict(state_dict)
+    return model.to(device).eval()
+
+def load_vocabulary(params_file, model):
+    """
+    TokenVocabulary saved next to `params_file` if `model` takes compact ids (its embedding has
+    window rows), else None.
+    """
+    if bcudemo.unwrap_model(model).embedding.window_rows is None:
+        return None
+    path = vocabulary_path(params_file)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"Token vocabulary not found: {path}")
+    return TokenVocabulary.load(path)
+
+def iter_flow_chunks(input_path, chunk_size):
+    """
+    Yield raw feature chunks (float ndarrays) from a CSV (any 'label' column is ignored) or a .npy matrix.
+    """
+    if input_path.endswith(".npy"):
+        flows = np.load(input_path, mmap_mode='r')
+        for start in range(0, len(flows), chunk_size):
+            yield np.asarray(flows[start:start + chunk_size])
+    else:
+        for chunk in pd.read_csv(input_path, chunksize=chunk_size):
+            yield chunk.drop(columns='label', errors='ignore').to_numpy()
+
+def num_input_features(input_path):
+    if input_path.endswith(".npy"):
+        return np.load(input_path, mmap_mode='r').shape[1]
+    header = pd.read_csv(input_path, nrows=0)
+    return len(header.columns.drop('label', errors='ignore'))
+
+def predict_tokens(model, tokens, batch_size):
+    """
+    Class indices and softmax confidences for a token matrix, `batch_size` rows per forward pass.
+    """
+    predictions = np.empty(len(tokens), dtype=np.int64)
+    confidences = np.empty(len(tokens), dtype=np.float32)
+    tokens = torch.from_numpy(tokens)
+    with torch.inference_mode(), bcudemo.autocast_context():
+        for start in range(0, len(tokens), batch_size):
+            batch = tokens[start:start + batch_size].to(device, non_blocking=True)
+            probabilities = torch.softmax(model(batch).float(), dim=-1)
+            confidence, prediction = probabilities.max(dim=-1)
+            predictions[start:start + len(batch)] = prediction.cpu().numpy()
+            confidences[start:start + len(batch)] = confidence.cpu().numpy()
+    return predictions, confidences
+
+class PredictionCache:
+    """
+    Bounded LRU map from a token row's bytes to its (class index, confidence), kept across chunks.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        result = self.entries.get(key)
+        if result is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return result
+
+    def put(self, key, result):
+        self.entries[key] = result
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+def unique_rows(tokens):
+    """
+    Distinct rows of a token matrix and, for every input row, the index of its distinct row.
+    Rows are viewed as single opaque values, so np.unique compares whole rows at once.
+    """
+    tokens = np.ascontiguousarray(tokens)
+    rows = tokens.view(np.dtype((np.void, tokens.dtype.itemsize * tokens.shape[1]))).ravel()
+    _, first, inverse = np.unique(rows, return_index=True, return_inverse=True)
+    return tokens[first], inverse.ravel()
+
+def predict_unique(model, tokens, batch_size, cache=None):
+    """
+    predict_tokens run once per distinct row (and only for rows missing from `cache`), scattered back
+    to every input row. Returns (predictions, confidences, number of distinct rows).
+    """
+    unique, inverse = unique_rows(tokens)
+    predictions = np.empty(len(unique), dtype=np.int64)
+    confidences = np.empty(len(unique), dtype=np.float32)
+
+    missing = np.arange(len(unique))
+    if cache is not None:
+        keys = [row.tobytes() for row in unique]
+        missing = []
+        for i, key in enumerate(keys):
+            result = cache.get(key)
+            if result is None:
+                missing.append(i)
+            else:
+                predictions[i], confidences[i] = result
+        missing = np.array(missing, dtype=np.int64)
+
+    if len(missing):
+        predictions[missing], confidences[missing] = predict_tokens(model, unique[missing], batch_size)
+        if cache is not None:
+            for i in missing:
+                cache.put(keys[i], (predictions[i], confidences[i]))
+    return predictions[inverse], confidences[inverse], len(unique)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="CSV (same feature columns as training) or .npy feature matrix")
+    parser.add_argument("--checkpoint", default=os.path.join(config['checkpoint_dir'], "best.pt"))
+    parser.add_argument("--scaler", default="scaling_parameters.json", help="Fitted DSRMMCustomScaler parameters")
+    parser.add_argument("--output", default="predictions.csv")
+    parser.add_argument("--batch-size", type=int, default=4096, help="Rows per forward pass")
+    parser.add_argument("--chunk-size", type=int, default=config['chunk_size'], help="Rows read and scaled at a time")
+    parser.add_argument("--dedup", action="store_true", help="Run the model once per distinct token row of each chunk")
+    parser.add_argument("--cache-size", type=int, default=0, help="With --dedup: LRU entries of results kept across chunks")
+    args = parser.parse_args()
+
+    scaler = load_scaler(args.scaler)
+    model = load_model(args.checkpoint, num_input_features(args.input))
+    vocabulary = load_vocabulary(args.scaler, model)
+
+    cache = PredictionCache(args.cache_size) if args.dedup and args.cache_size > 0 else None
+    total_flows, total_unique, model_seconds = 0, 0, 0.0
+    start = time.perf_counter()
+    with open(args.output, "w", newline="") as output:
+        for i, features in enumerate(iter_flow_chunks(args.input, args.chunk_size)):
+            tokens = scaler.transform_tokens(features, dtype=np.int64)
+            if vocabulary is not None:
+                tokens = vocabulary.encode(tokens)
+
+            model_start = time.perf_counter()
+            if args.dedup:
+                predictions, confidences, num_unique = predict_unique(model, tokens, args.batch_size, cache)
+                total_unique += num_unique
+            else:
+                predictions, confidences = predict_tokens(model, tokens, args.batch_size)
+            model_seconds += time.perf_counter() - model_start
+
+            pd.DataFrame({
+                'label': LABEL_NAMES[predictions],
+                'confidence': confidences,
+            }).to_csv(output, header=(i == 0), index=False, float_format="%.6f")
+            total_flows += len(tokens)
+    elapsed = time.perf_counter() - start
+
+    print(f"Classified {total_flows} flows -> {args.output}")
+    print(f"Throughput: {total_flows / elapsed:.1f} flows/sec end to end, {total_flows / max(model_seconds, 1e-9):.1f} flows/sec model only")
+    if args.dedup:
+        print(f"Distinct rows: {total_unique} of {total_flows} ({total_flows / max(total_unique, 1):.1f}x duplication)")
+    if cache is not None:
+        print(f"Result cache: {cache.hits} hits, {cache.misses} misses")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,310 @@
+"""
+Low-latency flow classification service with dynamic micro-batching.
+
+Single flow records are queued and grouped into micro-batches that wait at most
+--budget-ms for more flows (or until --max-batch), tokenized with the scaler's
+row fast path into a preallocated buffer, and scored with one forward pass per batch.
+
+    python serve.py --checkpoint checkpoints/best.pt --port 8080 --max-batch 64 --budget-ms 5
+    python serve.py client --url http://127.0.0.1:8080 --input estimate_1/subset_1.csv --concurrency 16
+
+Endpoints:
+    POST /classify  {"flow": [...]} or {"flows": [[...], ...]}  ->  {"label": ..., "confidence": ...} (or a list)
+    GET  /metrics   p50/p99 request latency, per-flow batch latency, queue depth, batch counts
+"""
+import argparse
+import collections
+import http.client
+import json
+import queue
+import threading
+import time
+import traceback
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+import torch
+
+import bcudemo
+from bcudemo import config, device
+from inference import LABEL_NAMES, load_model, load_scaler, load_vocabulary
+
+class PendingFlow:
+    """One queued flow and, once its micro-batch has run, its result (or the error that failed the batch)."""
+    __slots__ = ('row', 'enqueued', 'done', 'label', 'confidence', 'error')
+
+    def __init__(self, row):
+        self.row = row
+        self.enqueued = time.perf_counter()
+        self.done = threading.Event()
+        self.label = None
+        self.confidence = None
+        self.error = None
+
+class MicroBatcher:
+    """
+    Collect queued flows into micro-batches on a single worker thread and run the model once per batch.
+
+    A batch closes when it holds `max_batch` flows or when its oldest flow has waited `budget_s`.
+    Raw rows and tokens live in buffers allocated once, sized for `max_batch`.
+    """
+    def __init__(self, model, tokenizer, max_batch=64, budget_s=0.005, window=10000, vocabulary=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.vocabulary = vocabulary
+        self.max_batch = max_batch
+        self.budget_s = budget_s
+        self.queue = queue.Queue()
+
+        # Preallocated input buffers (pinned on CUDA so the host-to-device copy is asynchronous)
+        self.rows = np.empty((max_batch, tokenizer.num_features), dtype=np.float64)
+        self.tokens = torch.empty((max_batch, tokenizer.num_features), dtype=torch.long, pin_memory=device.type == 'cuda')
+        self.token_view = self.tokens.numpy()
+
+        # Metrics: queue-to-result latency per flow, and whole-request latency as the handler saw it
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=window)
+        self.request_latencies = collections.deque(maxlen=window)
+        self.batches = 0
+        self.flows = 0
+        self.failed_batches = 0
+        self.max_queue_depth = 0
+
+        self.warm_up()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def warm_up(self):
+        """Run the smallest and largest batch once, so start-up costs stay out of the latency metrics."""
+        self.token_view[:] = config['lower_bound']
+        with torch.inference_mode(), bcudemo.autocast_context():
+            for n in sorted({1, self.max_batch}):
+                self.model(self.tokens[:n].to(device))
+
+    def check_row(self, row):
+        """The flow as a float64 row; ValueError unless it has `num_features` finite values."""
+        row = np.asarray(row, dtype=np.float64)
+        if row.shape != (self.tokenizer.num_features,):
+            raise ValueError(f"Expected a flow with {self.tokenizer.num_features} features, got shape {row.shape}")
+        if not np.isfinite(row).all():
+            # NaN/inf would be cast to arbitrary tokens and still get a confident label
+            raise ValueError(f"Flow features must be finite, got {row[~np.isfinite(row)][:3].tolist()}")
+        return row
+
+    def submit(self, row):
+        pending = PendingFlow(self.check_row(row))
+        self.queue.put(pending)
+        with self.lock:
+            self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+        return pending
+
+    def run(self):
+        while True:
+            first = self.queue.get()
+            if first is None:
+                return
+            batch = [first]
+            deadline = first.enqueued + self.budget_s
+            while len(batch) < self.max_batch:
+                # Wait for more flows until the deadline; past it, still take whatever is already queued
+                remaining = deadline - time.perf_counter()
+                try:
+                    item = self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self.queue.put(None)  # Finish this batch, then stop
+                    break
+                batch.append(item)
+            try:
+                self.process(batch)
+            except Exception as e:
+                # Fail this batch's flows and keep the worker alive for the next one
+                traceback.print_exc()
+                with self.lock:
+                    self.failed_batches += 1
+                for pending in batch:
+                    pending.error = f"{type(e).__name__}: {e}"
+                    pending.done.set()
+
+    def process(self, batch):
+        n = len(batch)
+        for i, pending in enumerate(batch):
+            self.rows[i] = pending.row
+        self.tokenizer(self.rows[:n], out=self.token_view)
+        if self.vocabulary is not None:
+            self.vocabulary.encode(self.token_view[:n], out=self.token_view[:n])
+
+        with torch.inference_mode(), bcudemo.autocast_context():
+            logits = self.model(self.tokens[:n].to(device, non_blocking=True))
+            confidences, predictions = torch.softmax(logits.float(), dim=-1).max(dim=-1)
+        confidences, predictions = confidences.cpu().tolist(), predictions.cpu().tolist()
+
+        finished = time.perf_counter()
+        with self.lock:
+            self.batches += 1
+            self.flows += n
+            self.latencies.extend(finished - pending.enqueued for pending in batch)
+        for pending, prediction, confidence in zip(batch, predictions, confidences):
+            pending.label = str(LABEL_NAMES[prediction])
+            pending.confidence = confidence
+            pending.done.set()
+
+    def record_request(self, seconds):
+        with self.lock:
+            self.request_latencies.append(seconds)
+
+    def metrics(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1e3
+            request_latencies = np.array(self.request_latencies) * 1e3
+            batches, flows, failed_batches = self.batches, self.flows, self.failed_batches
+            max_queue_depth = self.max_queue_depth
+        p50, p99 = np.percentile(request_latencies, [50, 99]) if len(request_latencies) else (0.0, 0.0)
+        batch_p50, batch_p99 = np.percentile(latencies, [50, 99]) if len(latencies) else (0.0, 0.0)
+        return {
+            'p50_ms': float(p50),  # Whole request: body read, micro-batch wait, model, response write
+            'p99_ms': float(p99),
+            'batch_p50_ms': float(batch_p50),  # Per flow: enqueue to result
+            'batch_p99_ms': float(batch_p99),
+            'queue_depth': self.queue.qsize(),
+            'max_queue_depth': max_queue_depth,
+            'batches': batches,
+            'flows': flows,
+            'failed_batches': failed_batches,
+            'mean_batch_size': flows / batches if batches else 0.0,
+        }
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+class ClassifyHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, so clients do not reconnect per flow
+    disable_nagle_algorithm = True  # Headers and body go out as separate small writes; Nagle + delayed ACK would hold the body ~40 ms
+    batcher = None
+    timeout_s = 5.0
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            self.send_json(200, self.batcher.metrics())
+        else:
+            self.send_json(404, {'error': f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        start = time.perf_counter()
+        if self.path != "/classify":
+            self.send_json(404, {'error': f"Unknown path {self.path}"})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            flows = request['flows'] if 'flows' in request else [request['flow']]
+            rows = [self.batcher.check_row(flow) for flow in flows]  # Validate all before queueing any
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        pending = [self.batcher.submit(row) for row in rows]
+        if not all(p.done.wait(self.timeout_s) for p in pending):
+            self.send_json(503, {'error': "Timed out waiting for the model"})
+            return
+        errors = [p.error for p in pending if p.error is not None]
+        if errors:
+            self.send_json(500, {'error': errors[0]})
+            return
+        results = [{'label': p.label, 'confidence': p.confidence} for p in pending]
+        self.send_json(200, results if 'flows' in request else results[0])
+        self.batcher.record_request(time.perf_counter() - start)
+
+    def log_message(self, format, *args):
+        pass  # Per-request access logs would dominate the latency budget
+
+def serve(args):
+    scaler = load_scaler(args.scaler)
+    tokenizer = scaler.row_tokenizer()
+    model = load_model(args.checkpoint, tokenizer.num_features)
+    vocabulary = load_vocabulary(args.scaler, model)
+    ClassifyHandler.batcher = MicroBatcher(model, tokenizer, args.max_batch, args.budget_ms / 1e3, vocabulary=vocabulary)
+
+    server = ThreadingHTTPServer((args.host, args.port), ClassifyHandler)
+    server.daemon_threads = True
+    print(f"Serving on http://{args.host}:{server.server_port} (max batch {args.max_batch}, budget {args.budget_ms} ms)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        ClassifyHandler.batcher.close()
+
+def client(args):
+    """
+    Load generator: `concurrency` keep-alive connections each posting single flows.
+    """
+    url = urllib.parse.urlsplit(args.url)
+    if args.input:
+        flows = pd.read_csv(args.input, nrows=args.requests).drop(columns='label', errors='ignore').to_numpy()
+    else:
+        flows = np.random.default_rng(0).lognormal(3, 2, size=(args.requests, args.features))
+    bodies = [json.dumps({'flow': flow.tolist()}).encode() for flow in flows]
+
+    def worker(offset):
+        connection = http.client.HTTPConnection(url.hostname, url.port)
+        latencies = []
+        for i in range(offset, args.requests, args.concurrency):
+            start = time.perf_counter()
+            connection.request("POST", "/classify", body=bodies[i % len(bodies)], headers={"Content-Type": "application/json"})
+            response = connection.getresponse()
+            response.read()
+            if response.status != 200:
+                raise RuntimeError(f"HTTP {response.status} from the server")
+            latencies.append(time.perf_counter() - start)
+        connection.close()
+        return latencies
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        latencies = np.concatenate([np.array(l) for l in pool.map(worker, range(args.concurrency))]) * 1e3
+    elapsed = time.perf_counter() - start
+
+    connection = http.client.HTTPConnection(url.hostname, url.port)
+    connection.request("GET", "/metrics")
+    server_metrics = json.loads(connection.getresponse().read())
+    p50, p99 = np.percentile(latencies, [50, 99])
+    print(f"client: {args.requests} flows in {elapsed:.2f} s ({args.requests / elapsed:.1f} flows/sec), p50 {p50:.2f} ms, p99 {p99:.2f} ms")
+    print(f"server: {json.dumps(server_metrics)}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("mode", nargs="?", choices=["serve", "client"], default="serve")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--checkpoint", default=f"{config['checkpoint_dir']}/best.pt")
+    parser.add_argument("--scaler", default="scaling_parameters.json")
+    parser.add_argument("--max-batch", type=int, default=64, help="Flows per micro-batch at most")
+    parser.add_argument("--budget-ms", type=float, default=5.0, help="Longest a flow waits for its micro-batch to fill")
+    parser.add_argument("--url", default="http://127.0.0.1:8080", help="client: server address")
+    parser.add_argument("--input", help="client: CSV of flows to send (default: synthetic)")
+    parser.add_argument("--requests", type=int, default=2000, help="client: flows to send")
+    parser.add_argument("--concurrency", type=int, default=16, help="client: parallel connections")
+    parser.add_argument("--features", type=int, default=46, help="client: features per synthetic flow")
+    args = parser.parse_args()
+
+    torch.set_grad_enabled(False)
+    if args.mode == "serve":
+        serve(args)
+    else:
+        client(args)
+
+if __name__ == "__main__":
+    main()